@@ -1,90 +1,359 @@
-from itertools import chain, cycle
+import math
+import os
+import random
+import string
+from collections.abc import Buffer
+from functools import cache
+from itertools import permutations
 
-from crypto import OFFSET_LOWER, OFFSET_DIGIT, add_unique, batched, collect_to_str, AsciiTranslationTable
+from crypto import (BASIC_TABLE, INVALID, OFFSET_UPPER, AsciiTranslationTable, BufferCipher, add_unique,
+	batched, byte_view, cached, output_buffer, text_call)
 
+try:
+	import vector
+except ImportError:
+	vector = None
 
-def _to_code(a):
-	c = ord(a)
-	if c >= OFFSET_UPPER:
-		return (c - OFFSET_UPPER) & 0x1F
-	return c - OFFSET_DIGIT
+TEXT_FILTER = AsciiTranslationTable.with_letters(string.digits)
+TEXT_FILTER.compile()
 
 
-class Adfgvx:
+class Adfgvx(BufferCipher):
 
-	def __init__(self, grid, keyword, coord='ADFGVX'):
-		# TODO: make this numeric and avoid dicts?
-		coord = coord.upper()
-		subs = {}
-		inv_subs = {}
+	def __init__(self, grid, keyword, coord='ADFGVX', pad='X'):
+		coord = coord.upper().encode('ascii')
+		# flat tables indexed by character code; INVALID marks characters not in the grid
+		row_coord = bytearray([INVALID]) * 256
+		col_coord = bytearray([INVALID]) * 256
+		letters = bytearray()
 		unique = set()
 		for i, row in enumerate(grid):
 			for j, c in enumerate(row):
 				if not add_unique(unique, c):
 					raise ValueError(f"duplicate grid char: {c}")
-				s = (coord[i], coord[j])
-				subs[c.lower()] = s
-				inv_subs[s] = c.upper()
-		self.subs = subs
-		self.inv_subs = inv_subs
+				for a in {ord(c.lower()), ord(c.upper())}:
+					row_coord[a] = coord[i]
+					col_coord[a] = coord[j]
+				letters.append(ord(c.lower()))
+		self.row_coord = bytes(row_coord)
+		self.col_coord = bytes(col_coord)
+		self.coord_index = _coord_index(coord)
+		self.letters = bytes(letters)
+		self.side = len(coord)
 		self.keyword = keyword
-		self.inv_keyword = get_inv_keyword(keyword)
+		if len(pad) != 1:
+			raise ValueError(f"pad must be one character: {pad!r}")
+		# the coordinates of the character that fills out the last row
+		self.pad = self._substitute(pad.encode('ascii'))
 
-	@collect_to_str
-	def encrypt(self, message, pad_char='X'):
-		subs = chain.from_iterable(self.subs[c.lower()] for c in message)
-		pad = cycle(self.subs[pad_char.lower()])
-		rows = batched(subs, len(self.keyword), pad)
-		columns = zip(*rows)
-		scrambled = scramble(columns, self.keyword)
-		for column in scrambled:
-			yield from column
+	@classmethod
+	def cache_key(cls, grid, keyword, coord='ADFGVX', pad='X'):
+		# the grid must be a sequence of rows, not an iterator, since create reads it again
+		return tuple(''.join(row).lower() for row in grid), keyword, coord.upper(), pad.lower()
 
-	@collect_to_str
-	def decrypt(self, message):
-		col_len = len(message) // len(self.keyword)
-		columns = batched(message, col_len)
-		unscrambled = scramble(columns, self.inv_keyword)
-		rows = zip(*unscrambled)
-		subs = chain.from_iterable(rows)
-		inv_subs = self.inv_subs
-		for c1, c2 in batched(subs, 2, drop=True):
-			yield inv_subs[(c1.upper(), c2.upper())].lower()
+	def _substitute(self, data: bytes):
+		rows = data.translate(self.row_coord)
+		if INVALID in rows:
+			bad = chr(data[rows.index(INVALID)])
+			raise ValueError(f"char not in grid: {bad}")
+		stream = bytearray(2 * len(data))
+		stream[0::2] = rows
+		stream[1::2] = data.translate(self.col_coord)
+		return stream
 
+	def encrypt_into(self, data: Buffer, out: Buffer | None = None, pad_char: str | None = None):
+		"""The output is more than twice as long as data, so this cannot be done in place.
+		pad_char replaces the cipher's pad for this message."""
+		stream = self._substitute(byte_view(data).tobytes())
+		pad_len = -len(stream) % len(self.keyword)
+		pad = self.pad if pad_char is None else self._substitute(pad_char.encode('ascii'))
+		stream += (pad * pad_len)[:pad_len]
+		return transpose(stream, self.keyword, output_buffer(out, len(stream)))
 
-def scramble(columns, keyword):
-	for _, column in sorted(zip(keyword, columns)):
-		yield column
+	def decrypt_into(self, data: Buffer, out: Buffer | None = None):
+		stream = untranspose(byte_view(data), self.keyword)
+		coords = stream.translate(self.coord_index)
+		if INVALID in coords:
+			raise ValueError(f"invalid coordinate: {chr(stream[coords.index(INVALID)])}")
+		out = output_buffer(out, len(coords) // 2)
+		side = self.side
+		if vector and vector.accepts(coords):
+			np = vector.np
+			coords = np.frombuffer(coords, dtype=np.uint8).astype(np.intp)
+			letters = np.frombuffer(self.letters, dtype=np.uint8)
+			np.take(letters, coords[0:-1:2] * side + coords[1::2], out=np.frombuffer(out, dtype=np.uint8))
+		else:
+			letters = self.letters
+			out[:] = bytes([letters[a * side + b] for a, b in zip(coords[0:-1:2], coords[1::2])])
+		return out
+
+	def encrypt(self, message: str, pad_char: str | None = None):
+		return text_call(self.encrypt_into, message, pad_char=pad_char)
+
+
+def _coord_index(coord: bytes):
+	coord_index = bytearray([INVALID]) * 256
+	for i, a in enumerate(coord):
+		coord_index[a] = i
+		coord_index[ord(chr(a).lower())] = i
+	return bytes(coord_index)
+
+
+@cache
+def column_order(keyword: str):
+	"""The columns in the order they are read off. Ties in the keyword keep their original order."""
+	return tuple(i for _, i in sorted((c, i) for i, c in enumerate(keyword)))
+
+
+def transpose(stream: bytes, keyword: str, out: Buffer | None = None):
+	"""Reads a stream written in rows of len(keyword) out by columns in keyword order."""
+	width = len(keyword)
+	col_len, rem = divmod(len(stream), width)
+	if rem:
+		raise ValueError(f"stream of length {len(stream)} does not fill rows of {width}")
+	if out is None:
+		return b''.join(stream[i::width] for i in column_order(keyword))
+	for k, i in enumerate(column_order(keyword)):
+		out[k * col_len:(k + 1) * col_len] = stream[i::width]
+	return out
+
+
+def untranspose(stream: Buffer, keyword: str):
+	width = len(keyword)
+	col_len, rem = divmod(len(stream), width)
+	if rem:
+		raise ValueError(f"iterable had {rem} items left over")
+	rows = bytearray(len(stream))
+	for k, i in enumerate(column_order(keyword)):
+		rows[i::width] = stream[k * col_len:(k + 1) * col_len]
+	return rows
+
+
+# Solver: recovers the transposition from ciphertext alone. Needs NumPy.
+#
+# Only when the columns are in the right order do the coordinates pair up into
+# the grid's symbols, which then have the lopsided distribution of a simple
+# substitution (aligned coordinate digraphs are the substitution's monographs).
+# Each pair of adjacent positions in a row contributes the histogram of the
+# symbols made from two ciphertext columns, so a permutation is scored from
+# per-column-pair histograms without rebuilding the text.
+
+EXHAUSTIVE_MAX = 8
+# rank_keywords tries every keyword equivalent to each one given, for classes up to this size
+EQUIVALENT_MAX = 1440
+
+
+def _slots(width: int):
+	"""The (position, next position, kind) of every coordinate pair within a row.
+	With an odd width, pairs start on even positions in even rows and on odd
+	positions in odd rows, and the last position of an even row pairs with the
+	first position of the next row."""
+	if width % 2 == 0:
+		return [(j, j + 1, 'all') for j in range(0, width, 2)]
+	slots = [(j, j + 1, 'even' if j % 2 == 0 else 'odd') for j in range(width - 1)]
+	slots.append((width - 1, 0, 'wrap'))
+	return slots
+
+
+class _Transposition:
+	"""Pair histograms of one ciphertext for one keyword length."""
 
+	def __init__(self, coords, width: int, side: int):
+		np = vector.np
+		self.width = width
+		symbols = side * side
+		columns = coords.reshape(width, -1).astype(np.intp)
+		pairs = columns[:, np.newaxis, :] * side + columns[np.newaxis, :, :]
+		offsets = (np.arange(width * width) * symbols).reshape(width, width, 1)
 
-def get_inv_keyword(keyword):
-	indexed = sorted((c, i) for i, c in enumerate(keyword))
-	return [i for _, i in indexed]
+		def histograms(codes):
+			counts = np.bincount((codes + offsets).ravel(), minlength=width * width * symbols)
+			return counts.reshape(width, width, symbols)
+
+		even, odd = histograms(pairs[:, :, 0::2]), histograms(pairs[:, :, 1::2])
+		wrap = columns[:, np.newaxis, 0:-1:2] * side + columns[np.newaxis, :, 1::2]
+		self.tables = {'all': even + odd, 'even': even, 'odd': odd, 'wrap': histograms(wrap)}
+		self.slots = [(a, b, self.tables[kind]) for a, b, kind in _slots(width)]
+		self.slots_at = [[k for k, (a, b, _) in enumerate(self.slots) if j in (a, b)] for j in range(width)]
+		self.symbols = symbols
+
+	def coincidence(self, histogram) -> float:
+		"""Index of coincidence of the symbols, scaled so random coordinates score 1.0."""
+		total = histogram.sum(axis=-1)
+		return self.symbols * (histogram * (histogram - 1)).sum(axis=-1) / (total * (total - 1))
+
+	def histogram(self, perms):
+		"""Symbol histograms for permutations given as an (n, width) array of column indices."""
+		return sum(table[perms[:, a], perms[:, b]] for a, b, table in self.slots)
+
+	def canonical(self, perm: tuple[int, ...]):
+		"""With an even width, reordering whole pairs or swapping the two columns
+		of every pair (transposing the grid) scores the same, so normalize those."""
+		if self.width % 2:
+			return perm
+		pairs = list(zip(perm[0::2], perm[1::2]))
+		flipped = [(b, a) for a, b in pairs]
+		return tuple(c for pair in min(sorted(pairs), sorted(flipped)) for c in pair)
+
+	def climb(self, rng: random.Random, patience: int):
+		np = vector.np
+		perm = list(range(self.width))
+		rng.shuffle(perm)
+		histogram = self.histogram(np.array([perm]))[0]
+		score = self.coincidence(histogram)
+		stale = 0
+		while stale < patience:
+			i, j = rng.sample(range(self.width), 2)
+			touched = set(self.slots_at[i] + self.slots_at[j])
+			old = sum(self.slots[k][2][perm[self.slots[k][0]], perm[self.slots[k][1]]] for k in touched)
+			perm[i], perm[j] = perm[j], perm[i]
+			new = sum(self.slots[k][2][perm[self.slots[k][0]], perm[self.slots[k][1]]] for k in touched)
+			new_histogram = histogram - old + new
+			new_score = self.coincidence(new_histogram)
+			if new_score > score:
+				histogram, score = new_histogram, new_score
+				stale = 0
+			else:
+				perm[i], perm[j] = perm[j], perm[i]
+				stale += 1
+		return float(score), tuple(perm)
+
+
+def _search_transposition(coords, width: int, side: int, first: int | None, restarts: int, seed: int, top: int):
+	"""Scores every permutation starting with column first, or climbs from random starts if first is None."""
+	np = vector.np
+	transposition = _Transposition(coords, width, side)
+	if first is None:
+		rng = random.Random(seed)
+		results = [transposition.climb(rng, 4 * width * width) for _ in range(restarts)]
+	else:
+		rest = [c for c in range(width) if c != first]
+		perms = np.array([(first, *p) for p in permutations(rest)], dtype=np.intp).reshape(-1, width)
+		scores = transposition.coincidence(transposition.histogram(perms))
+		best = np.argsort(-scores)[:top * width]
+		results = [(float(scores[k]), tuple(int(c) for c in perms[k])) for k in best]
+	return [(score, transposition.canonical(perm)) for score, perm in results]
+
+
+def solve_transposition(message: str, min_len: int = 2, max_len: int = 12, coord='ADFGVX',
+		workers: int | None = None, restarts: int = 64, top: int = 10):
+	"""Ranks transposition keywords for a ciphertext of grid coordinates, trying
+	every keyword length in the range that divides the message length (complete
+	rows, as encrypt pads them). Lengths up to EXHAUSTIVE_MAX are searched
+	exhaustively, longer ones by hill-climbing from random starts.
+	Returns (score, keyword) pairs, best first, with keywords as letters A, B, C, ...
+	in column order. The score is the symbols' scaled index of coincidence."""
+	from concurrent.futures import ProcessPoolExecutor
+	coord = coord.upper().encode('ascii')
+	stream = message.encode('ascii').translate(_coord_index(coord))
+	if INVALID in stream:
+		raise ValueError(f"invalid coordinate: {chr(message.encode('ascii')[stream.index(INVALID)])}")
+	coords = vector.np.frombuffer(stream, dtype=vector.np.uint8)
+	widths = [w for w in range(max(min_len, 2), min(max_len, 26) + 1) if len(coords) % w == 0 and len(coords) >= 4 * w]
+	workers = workers or os.cpu_count() or 1
+	with ProcessPoolExecutor(workers) as pool:
+		futures = []
+		for width in widths:
+			if width <= EXHAUSTIVE_MAX:
+				futures += [pool.submit(_search_transposition, coords, width, len(coord), first, 0, 0, top)
+					for first in range(width)]
+			else:
+				futures += [pool.submit(_search_transposition, coords, width, len(coord), None, -(-restarts // workers), seed, top)
+					for seed in range(workers)]
+		results = {perm: score for f in futures for score, perm in f.result()}
+	ranked = sorted(((score, ''.join(chr(c + OFFSET_UPPER) for c in perm)) for perm, score in results.items()), reverse=True)
+	return ranked[:top]
+
+
+def equivalent_keywords(keyword: str):
+	"""The keywords that solve_transposition cannot tell apart from keyword, which
+	it gives one of: for an even length, those with its column pairs in any order,
+	and with the two columns of every pair swapped or not."""
+	if len(keyword) % 2:
+		return [keyword]
+	pairs = [keyword[i:i + 2] for i in range(0, len(keyword), 2)]
+	flipped = [pair[::-1] for pair in pairs]
+	return [''.join(order) for p in (pairs, flipped) for order in permutations(p)]
+
+
+def equivalents_count(keyword: str):
+	return 1 if len(keyword) % 2 else 2 * math.factorial(len(keyword) // 2)
+
+
+def rank_keywords(message: str, keywords, grid, coord, ngrams):
+	"""Ranks transposition keywords, such as those from solve_transposition, by the
+	n-gram fitness (see fitness.NGrams) of what each decrypts to with a known grid,
+	trying every keyword equivalent to each (see equivalent_keywords) unless there
+	are more than EQUIVALENT_MAX. Returns (fitness, keyword) pairs, best first;
+	fitness is the mean log10 quadgram probability of the letters."""
+	data = message.encode('ascii')
+	keywords = list(dict.fromkeys(k for keyword in keywords for k in (
+		equivalent_keywords(keyword) if equivalents_count(keyword) <= EQUIVALENT_MAX else [keyword])))
+	texts = [vector.letter_codes(BASIC_TABLE.translate_bytes(Adfgvx(grid, keyword, coord).decrypt_into(data)))
+		for keyword in keywords]
+	scores = ngrams.score_batch(texts)
+	return sorted(((float(score) / max(len(text) - 3, 1), keyword)
+		for score, text, keyword in zip(scores, texts, keywords)), reverse=True)
 
 
 if __name__ == '__main__':
 	import argparse
-	import math
-	import string
+	import sys
 
 	import cryptoshell
 
 	parser = argparse.ArgumentParser(prog='adfgvx',
 		description=f"Applies the ADFGVX Cipher to a message. {cryptoshell.MODE_HELP}")
 	cryptoshell.input_args(parser)
-	parser.add_argument('-g', '--grid', type=str, required=True,
+	parser.add_argument('-g', '--grid', type=str,
 		help='The full text of the substitution grid. Row separators (such as commas) may be included, as all invalid characters are ignored.')
-	parser.add_argument('-k', '--keyword', type=str, required=True,
+	key_group = parser.add_mutually_exclusive_group(required=True)
+	key_group.add_argument('-k', '--keyword', type=str,
 		help='the transposition keyword')
+	key_group.add_argument('-s', '--solve', metavar='LENGTHS', type=str,
+		help='Rank transposition keywords for a ciphertext alone, trying keyword lengths in the range MIN-MAX (such as 2-12). Keywords are shown as letters in column order.')
 	parser.add_argument('-c', '--coordinates', metavar='COORD', type=str,
 		help='The letters to use for the grid coordinates. Defaults to ADFGVX for a 6x6 grid and ADFGX for 5x5.')
 	parser.add_argument('-p', '--pad', type=str,
 		help='the pad character to fill out an incomplete row. Defaults to X.')
+	parser.add_argument('-w', '--workers', type=int,
+		help='the number of processes to solve with. Defaults to one per CPU.')
+	parser.add_argument('--corpus', metavar='FILE', type=str,
+		help='when solving with a known grid, rank the keywords by the n-gram fitness of their decryptions, from an index built by fitness.py or a file of English text to count them from')
 	cryptoshell.mode_args(parser)
+	cryptoshell.batch_args(parser)
+	cryptoshell.stream_args(parser)
+	cryptoshell.stats_args(parser)
+	cryptoshell.daemon_args(parser)
 	args = parser.parse_args()
-	text_filter = AsciiTranslationTable.with_letters(string.digits)
+	stats = cryptoshell.Stats.from_args(args)
 
-	grid = args.grid.translate(text_filter)
+	if args.solve:
+		if vector is None:
+			parser.error('--solve requires NumPy')
+		min_len, _, max_len = args.solve.partition('-')
+		message = TEXT_FILTER.translate(cryptoshell.get_message(args))
+		coord = args.coordinates or 'ADFGVX'
+		ranked = solve_transposition(message, int(min_len), int(max_len or min_len), coord, args.workers)
+		if args.corpus:
+			if not args.grid:
+				parser.error('--corpus requires -g/--grid')
+			from fitness import NGrams
+			grid = TEXT_FILTER.translate(args.grid)
+			ranked = rank_keywords(message, [keyword for _, keyword in ranked],
+				list(batched(grid, len(coord))), coord, NGrams.from_file(args.corpus))[:len(ranked)]
+		undetermined = sorted({len(keyword) for _, keyword in ranked
+			if len(keyword) % 2 == 0 and (not args.corpus or equivalents_count(keyword) > EQUIVALENT_MAX)})
+		if undetermined:
+			print(f"keywords of length {', '.join(map(str, undetermined))} are only found up to the order of their column "
+				'pairs and swapping the two columns of every pair' + ('' if args.corpus else ' (give -g and --corpus to tell them apart)'),
+				file=sys.stderr)
+		print('\n'.join(f"{keyword}:{score:.3f}" for score, keyword in ranked), end='')
+		sys.exit()
+	if not args.grid:
+		parser.error('the following arguments are required: -g/--grid')
+
+	grid = TEXT_FILTER.translate(args.grid)
 
 	side_len = math.isqrt(len(grid))
 	if side_len ** 2 != len(grid):
@@ -101,5 +370,13 @@ if __name__ == '__main__':
 	elif len(coord) != side_len:
 		raise ValueError(f"Coordinates have length {side_len} to match size of grid")
 
-	cipher = Adfgvx(batched(grid, side_len), args.keyword, coord)
-	cryptoshell.run_cipher(args, cipher.encrypt, cipher.decrypt, text_filter)
+	from functools import partial
+
+	pad = args.pad or 'X'
+	if cryptoshell.forward(args, 'adfgvx', args.keyword, {'grid': grid, 'coord': coord, 'pad': pad}):
+		sys.exit()
+	cipher_for = partial(cached, Adfgvx, list(batched(grid, side_len)), coord=coord, pad=pad)
+	with stats.phase('setup'):
+		cipher = cipher_for(args.keyword)
+	cryptoshell.run_cipher(args, cipher.encrypt_into, cipher.decrypt_into, TEXT_FILTER, cipher_for=cipher_for,
+		stats=stats, cipher=cipher)
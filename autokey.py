@@ -1,28 +1,71 @@
-from collections import deque
-from itertools import chain
+from collections.abc import Buffer
 
-from crypto import OFFSET_LOWER, OFFSET_UPPER, collect_to_str, to_code
+import modular
+from crypto import LETTERS, Alphabet, BufferCipher, CipherStream, byte_view, cached, get_alphabet, text_call
 
 
-@collect_to_str
-def encrypt(message: str, key: str):
-	message_code = [to_code(a) for a in message]
-	key_code = (to_code(k) for k in key)
-	for c, k in zip(message_code, chain(key_code, message_code)):
-		yield chr(((c + k) % 26) + OFFSET_UPPER)
+def encrypt_into(data: Buffer, key: str, out: Buffer | None = None, alphabet: Alphabet = LETTERS):
+	return modular.autokey_into(data, alphabet, alphabet.codes(key), +1, out)
 
 
-@collect_to_str
-def decrypt(message: str, key: str):
-	queue = deque(to_code(k) for k in key)
-	for a in message:
-		c = (to_code(a) - queue.popleft()) % 26
-		queue.append(c)
-		yield chr(x + OFFSET_LOWER)
+def decrypt_into(data: Buffer, key: str, out: Buffer | None = None, alphabet: Alphabet = LETTERS):
+	return modular.autokey_into(data, alphabet, alphabet.codes(key), -1, out)
+
+
+def encrypt(message: str, key: str, alphabet: Alphabet = LETTERS):
+	return text_call(encrypt_into, message, key, alphabet=alphabet)
+
+
+def decrypt(message: str, key: str, alphabet: Alphabet = LETTERS):
+	return text_call(decrypt_into, message, key, alphabet=alphabet)
+
+
+class Autokey(BufferCipher):
+	__slots__ = ('key', 'alphabet')
+
+	def __init__(self, key: str, alphabet: Alphabet | str = LETTERS):
+		self.alphabet = get_alphabet(alphabet)
+		self.key = self.alphabet.codes(key)
+
+	@classmethod
+	def cache_key(cls, key: str, alphabet: Alphabet | str = LETTERS):
+		alphabet = get_alphabet(alphabet)
+		return alphabet.codes(key), alphabet.chars
+
+	def encrypt_into(self, data: Buffer, out: Buffer | None = None):
+		return modular.autokey_into(data, self.alphabet, self.key, +1, out)
+
+	def decrypt_into(self, data: Buffer, out: Buffer | None = None):
+		return modular.autokey_into(data, self.alphabet, self.key, -1, out)
+
+	def encryptor(self):
+		return _AutokeyStream(self.key, self.alphabet, +1)
+
+	def decryptor(self):
+		return _AutokeyStream(self.key, self.alphabet, -1)
+
+
+class _AutokeyStream(CipherStream):
+	"""The keystream at each position is the plaintext one key length back, so
+	each chunk is enciphered with the last key length of plaintext as its key."""
+	__slots__ = ('key', 'alphabet', 'sign')
+
+	def __init__(self, key: bytes, alphabet: Alphabet, sign: int):
+		self.key = key
+		self.alphabet = alphabet
+		self.sign = sign
+
+	def update(self, data: Buffer):
+		out = modular.autokey_into(data, self.alphabet, self.key, self.sign, None)
+		plain = byte_view(out if self.sign < 0 else data)
+		n = len(self.key)
+		self.key = (self.key + self.alphabet.codes(plain[-n:]))[-n:]
+		return out
 
 
 if __name__ == '__main__':
 	import argparse
+	import sys
 	from functools import partial
 
 	import cryptoshell
@@ -31,9 +74,18 @@ if __name__ == '__main__':
 		description=f"Applies the Autokey Cipher to a message. {cryptoshell.MODE_HELP}")
 	cryptoshell.input_args(parser)
 	parser.add_argument('-k', '--key', type=str, help='the cipher key')
+	cryptoshell.alphabet_args(parser)
 	cryptoshell.mode_args(parser)
+	cryptoshell.batch_args(parser)
+	cryptoshell.stream_args(parser)
+	cryptoshell.stats_args(parser)
+	cryptoshell.daemon_args(parser)
 	args = parser.parse_args()
+	stats = cryptoshell.Stats.from_args(args)
 
-	cryptoshell.run_cipher(args,
-		partial(encrypt, key=args.key), 
-		partial(decrypt, key=args.key))
+	options = {'alphabet': args.alphabet} if args.alphabet else {}
+	if cryptoshell.forward(args, 'autokey', args.key, options):
+		sys.exit()
+	cipher = Autokey(args.key, **options)
+	cryptoshell.run_cipher(args, cipher.encrypt_into, cipher.decrypt_into, cipher.alphabet.text_filter,
+		cipher_for=partial(cached, Autokey, **options), stats=stats, cipher=cipher)
@@ -0,0 +1,317 @@
+import hashlib
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+from collections.abc import Callable
+from contextlib import contextmanager
+from functools import partial
+from string import ascii_lowercase, digits
+
+import adfgvx
+import autokey
+import caesar
+import cryptoshell
+import enigma
+import greenwall
+import modular
+import playfair
+import vigenere
+from crypto import ALPHABETS, BASIC_TABLE, AsciiTranslationTable, BufferCipher, batched, get_alphabet
+
+try:
+	import vector
+except ImportError:
+	vector = None
+
+KB = 1 << 10
+MB = 1 << 20
+SIZES = (KB, 16 * KB, 256 * KB, MB, 10 * MB, 100 * MB)
+# the pure Python engines take seconds per megabyte, so by default they stop here
+PURE_MAX = MB
+SHORT_LEN = 64
+SHORT_CALLS = 1000
+# each timing is the best of up to REPEATS runs, stopping once they add up to TIME_BUDGET seconds
+REPEATS = 5
+TIME_BUDGET = 0.2
+THRESHOLD = 0.2
+SEED = 1553
+JOBS = os.cpu_count() or 1
+
+
+class Case:
+	"""A cipher set up for benchmarking. encrypt and decrypt take and return bytes;
+	modules lists where the engines are switched (see engines). A seekable cipher
+	is also run split between processes, as with --jobs, after text_filter."""
+
+	def __init__(self, name: str, alphabet: str, encrypt: Callable[[bytes], bytes],
+			decrypt: Callable[[bytes], bytes], modules=(), max_size: int = SIZES[-1],
+			cipher: BufferCipher | None = None, text_filter: AsciiTranslationTable = BASIC_TABLE):
+		self.name = name
+		self.alphabet = alphabet
+		self.encrypt = encrypt
+		self.decrypt = decrypt
+		self.modules = modules
+		self.max_size = max_size
+		self.cipher = cipher if cipher is not None and cipher.seekable else None
+		self.text_filter = text_filter
+
+
+def _caesar_analyze(data: bytes):
+	return '\n'.join(shift for _, shift in caesar.analyze(data.decode('ascii'), top=1)).encode('ascii')
+
+
+def _caesar_shift(data: bytes):
+	return ''.join(caesar.iter_shift(data.decode('ascii'), 3)).encode('ascii')
+
+
+def cases():
+	play = playfair.Playfair.from_keyword('PLAYFAIREXAMPLE')
+	lemon = vigenere.Vigenere('LEMON')
+	lemon36 = vigenere.Vigenere('LEMON42', '36')
+	grid = adfgvx.Adfgvx(list(batched('NA1C3H8TB2OME5WRPD4F6G7I9J0KLQSUVXYZ', 6)), 'PRIVACY')
+	wall = greenwall.Greenwall('HORIZONTAL', 'VERTICAL')
+	machine = enigma.Enigma(['I', 'II', 'III'], 'ADU', 'BBB', plugboard='AB CD EF')
+	return [
+		Case('caesar', ascii_lowercase, _caesar_shift, _caesar_analyze, max_size=10 * MB),
+		Case('vigenere', ascii_lowercase, lemon.encrypt_into, lemon.decrypt_into, [modular], cipher=lemon),
+		Case('vigenere36', ALPHABETS['36'].lower(), lemon36.encrypt_into, lemon36.decrypt_into, [modular],
+			cipher=lemon36, text_filter=get_alphabet('36').text_filter),
+		Case('autokey', ascii_lowercase,
+			autokey.Autokey('QUEEN').encrypt_into, autokey.Autokey('QUEEN').decrypt_into, [modular]),
+		# with I and J combined, a pair like IJ would encrypt to a double letter
+		Case('playfair', ascii_lowercase.replace('j', ''), play.encrypt_into, play.decrypt_into, [playfair]),
+		Case('adfgvx', ascii_lowercase + digits, grid.encrypt_into, grid.decrypt_into, [adfgvx]),
+		Case('greenwall', ascii_lowercase + ' ,.', wall.encrypt_into, wall.decrypt_into, [modular],
+			cipher=wall, text_filter=greenwall.TEXT_FILTER),
+		# Enigma lists the rotor state of every key press, which needs too much memory beyond this
+		Case('enigma', ascii_lowercase, machine.encrypt_into, machine.decrypt_into, [enigma], max_size=10 * MB,
+			cipher=machine),
+	]
+
+
+def engines(case: Case):
+	"""Names of the engines a case can run with. Each module falls back to pure
+	Python when its vector module is None, which is how the engines are switched.
+	The parallel engine is the best of those, split between processes."""
+	names = ['python', 'numpy'] if vector and case.modules else ['python']
+	if case.cipher is not None:
+		names.append('parallel')
+	return names
+
+
+def operation(case: Case, op: str, name: str, jobs: int = JOBS) -> Callable[[bytes], bytes]:
+	if name == 'parallel':
+		return partial(_parallel, case, op == 'decrypt', jobs)
+	return case.encrypt if op == 'encrypt' else case.decrypt
+
+
+def _parallel(case: Case, decrypting: bool, jobs: int, data: bytes):
+	# peak memory is only measured in this process, not the workers
+	from multiprocessing.shared_memory import SharedMemory
+	shm = SharedMemory(create=True, size=max(len(data), 1))
+	try:
+		shm.buf[:len(data)] = data
+		# always in the pool, and split evenly between the workers, however short the message
+		ranges = cryptoshell.cipher_shared(shm, len(data), case.cipher, jobs, case.text_filter, decrypting,
+			min_size=0, chunk=max(-(-len(data) // jobs), 1))
+		out = bytearray()
+		for start, length in ranges:
+			with shm.buf[start:start + length] as view:
+				out += view
+		return out
+	finally:
+		shm.close()
+		shm.unlink()
+
+
+@contextmanager
+def engine(case: Case, name: str):
+	saved = [module.vector for module in case.modules]
+	try:
+		for module in case.modules:
+			module.vector = vector if name != 'python' else None
+		yield
+	finally:
+		for module, v in zip(case.modules, saved):
+			module.vector = v
+
+
+def message(alphabet: str, size: int, seed: int = SEED):
+	"""Deterministic random text of the given size, the same on every run."""
+	codes = alphabet.encode('ascii')
+	table = bytes(codes[b % len(codes)] for b in range(256))
+	return random.Random(seed).randbytes(size).translate(table)
+
+
+def best_time(func: Callable[[], object]):
+	times = []
+	while len(times) < REPEATS and sum(times) < TIME_BUDGET:
+		start = time.perf_counter()
+		func()
+		times.append(time.perf_counter() - start)
+	return min(times)
+
+
+def peak_memory(func: Callable[[], object]):
+	tracemalloc.start()
+	try:
+		func()
+		return tracemalloc.get_traced_memory()[1]
+	finally:
+		tracemalloc.stop()
+
+
+def measure(case: Case, sizes, pure_max: int = PURE_MAX, jobs: int = JOBS):
+	"""Yields a result for every operation, size and engine, and checks that
+	all the engines give the same output."""
+	for size in sizes:
+		if size > case.max_size:
+			continue
+		plain = message(case.alphabet, size)
+		cipher = bytes(case.encrypt(plain))
+		for op, data in (('encrypt', plain), ('decrypt', cipher)):
+			results = []
+			digests = set()
+			for name in engines(case):
+				if name == 'python' and size > pure_max and len(engines(case)) > 1:
+					continue
+				func = operation(case, op, name, jobs)
+				with engine(case, name):
+					digests.add(hashlib.sha256(func(data)).hexdigest())
+					seconds = best_time(lambda: func(data))
+					peak = peak_memory(lambda: func(data))
+				results.append({
+					'cipher': case.name, 'op': op, 'engine': name, 'size': size,
+					'seconds': seconds, 'chars_per_sec': size / seconds, 'peak_bytes': peak,
+				})
+			for result in results:
+				result['matches'] = len(digests) == 1
+				yield result
+
+
+def latency(case: Case, calls: int = SHORT_CALLS):
+	"""Yields the time per call for short messages, where the overhead of each call dominates."""
+	plain = message(case.alphabet, SHORT_LEN)
+	cipher = bytes(case.encrypt(plain))
+	for op, data in (('encrypt', plain), ('decrypt', cipher)):
+		# splitting between processes is only for long messages
+		for name in [name for name in engines(case) if name != 'parallel']:
+			func = operation(case, op, name)
+			with engine(case, name):
+				start = time.perf_counter()
+				for _ in range(calls):
+					func(data)
+				seconds = (time.perf_counter() - start) / calls
+			yield {'cipher': case.name, 'op': op, 'engine': name, 'size': SHORT_LEN, 'latency_us': seconds * 1e6}
+
+
+def _commit():
+	try:
+		return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+			capture_output=True, text=True, check=True).stdout.strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+
+def run(names=None, sizes=SIZES, pure_max: int = PURE_MAX, jobs: int = JOBS):
+	selected = [case for case in cases() if not names or case.name in names]
+	report = {
+		'commit': _commit(),
+		'python': platform.python_version(),
+		'numpy': vector.np.__version__ if vector else None,
+		'throughput': [],
+		'latency': [],
+	}
+	for case in selected:
+		for result in measure(case, sizes, pure_max, jobs):
+			report['throughput'].append(result)
+			print(f"{result['cipher']:10} {result['op']:8} {result['engine']:8} {_size_name(result['size']):>6}"
+				f" {result['chars_per_sec'] / 1e6:9.2f} Mchar/s {result['peak_bytes'] / MB:9.2f} MB peak"
+				+ ('' if result['matches'] else '  OUTPUT DIFFERS'), file=sys.stderr)
+		for result in latency(case):
+			report['latency'].append(result)
+			print(f"{result['cipher']:10} {result['op']:8} {result['engine']:8} {'short':>6}"
+				f" {result['latency_us']:9.1f} us/call", file=sys.stderr)
+	return report
+
+
+def _key(result):
+	return result['cipher'], result['op'], result['engine'], result['size']
+
+
+def regressions(report, baseline, threshold: float = THRESHOLD):
+	"""Results more than threshold (a fraction) slower than the same result in the baseline."""
+	found = []
+	before = {_key(r): r for r in baseline.get('throughput', ())}
+	for result in report['throughput']:
+		old = before.get(_key(result))
+		if old and result['chars_per_sec'] < old['chars_per_sec'] * (1 - threshold):
+			found.append((result, old['chars_per_sec']))
+	before = {_key(r): r for r in baseline.get('latency', ())}
+	for result in report['latency']:
+		old = before.get(_key(result))
+		if old and result['latency_us'] > old['latency_us'] * (1 + threshold):
+			found.append((result, old['latency_us']))
+	return found
+
+
+def _size_name(size: int):
+	if size >= MB:
+		return f"{size // MB}M"
+	if size >= KB:
+		return f"{size // KB}K"
+	return str(size)
+
+
+def parse_size(s: str):
+	s = s.strip().upper()
+	scale = {'K': KB, 'M': MB}.get(s[-1:], 1)
+	return int(s.rstrip('KM')) * scale
+
+
+if __name__ == '__main__':
+	import argparse
+
+	parser = argparse.ArgumentParser(
+		description='Measures the throughput, short-message latency and peak memory of every cipher with every engine, and checks that the engines agree. Progress goes to stderr.')
+	parser.add_argument('ciphers', nargs='*', help='the ciphers to run (default: all)')
+	parser.add_argument('-m', '--max-size', type=parse_size, default=MB,
+		help='the largest input to time, such as 100M (default: 1M)')
+	parser.add_argument('-p', '--pure-max', type=parse_size, default=PURE_MAX,
+		help='the largest input for the pure Python engines when another engine is available (default: 1M)')
+	parser.add_argument('-j', '--jobs', type=int, default=JOBS,
+		help='the number of processes for the parallel engine, which splits messages as --jobs does (default: one per CPU)')
+	parser.add_argument('-o', '--output', metavar='FILE', type=str,
+		help='write the results to this file as JSON')
+	parser.add_argument('-b', '--baseline', metavar='FILE', type=str,
+		help='compare with results saved by an earlier run, exiting with an error on any regression')
+	parser.add_argument('-t', '--threshold', type=float, default=THRESHOLD,
+		help='the slowdown that counts as a regression, as a fraction (default: 0.2)')
+	args = parser.parse_args()
+
+	report = run(args.ciphers, [s for s in SIZES if s <= args.max_size], args.pure_max, args.jobs)
+	if args.output:
+		with open(args.output, 'w', encoding='UTF-8') as f:
+			json.dump(report, f, indent='\t')
+
+	failed = False
+	mismatches = [r for r in report['throughput'] if not r['matches']]
+	for r in mismatches:
+		print(f"engines disagree: {r['cipher']} {r['op']} {_size_name(r['size'])}")
+		failed = True
+	if args.baseline:
+		with open(args.baseline, encoding='UTF-8') as f:
+			baseline = json.load(f)
+		for result, old in regressions(report, baseline, args.threshold):
+			if 'latency_us' in result:
+				change = f"{old:.1f} -> {result['latency_us']:.1f} us/call"
+			else:
+				change = f"{old / 1e6:.2f} -> {result['chars_per_sec'] / 1e6:.2f} Mchar/s"
+			print(f"regression: {result['cipher']} {result['op']} {result['engine']} {_size_name(result['size'])}: {change}")
+			failed = True
+	sys.exit(1 if failed else 0)
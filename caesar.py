@@ -1,5 +1,13 @@
 import itertools
-from crypto import OFFSET_LOWER, OFFSET_UPPER, to_code
+from crypto import BASIC_TABLE, OFFSET_LOWER, OFFSET_UPPER, chi_squared, letter_histogram, to_code
+
+try:
+	import vector
+except ImportError:
+	vector = None
+
+# letters of the message shifted each way to rank the shifts by n-gram fitness
+RANK_SAMPLE = 1 << 16
 
 
 def iter_shift(message: str, key: int, offset: int | None = None):
@@ -13,9 +21,34 @@ def iter_shift(message: str, key: int, offset: int | None = None):
 			yield c
 
 
-def analyze(message: str, max_len: int | None = None, sign: int = -1, offset=OFFSET_LOWER):
-	for e in range(1, 26):
-		yield ''.join(itertools.islice(iter_shift(
+def rank_shifts(message: str, sign: int = -1):
+	"""Returns the shifts 1-25 ordered from most to least English-like."""
+	histogram = letter_histogram(message)
+
+	def score(e: int):
+		s = sign * e
+		return chi_squared([histogram[(x - s) % 26] for x in range(26)])
+
+	return sorted(range(1, 26), key=score)
+
+
+def rank_shifts_by_fitness(message: str, ngrams, sign: int = -1):
+	"""Like rank_shifts, but by the n-gram fitness (see fitness.NGrams) of each
+	shift of the start of the message, all scored at once. Needs NumPy."""
+	np = vector.np
+	codes = vector.letter_codes(BASIC_TABLE.translate(message))[:RANK_SAMPLE].astype(np.int16)
+	shifts = np.arange(1, 26)
+	scores = ngrams.score_batch((codes + sign * shifts[:, np.newaxis]) % 26, max(min(len(codes), 4), 1))
+	return shifts[np.argsort(-scores, kind='stable')].tolist()
+
+
+def analyze(message: str, max_len: int | None = None, sign: int = -1, offset=OFFSET_LOWER,
+		top: int | None = None, ngrams=None):
+	"""Yields the shifts, most likely first, and the message under each. With ngrams,
+	they are ranked by n-gram fitness rather than by letter frequencies alone."""
+	ranked = rank_shifts(message, sign) if ngrams is None else rank_shifts_by_fitness(message, ngrams, sign)
+	for e in ranked[:top]:
+		yield e, ''.join(itertools.islice(iter_shift(
 			message, sign * e, offset), max_len))
 
 
@@ -28,10 +61,19 @@ if __name__ == '__main__':
 	cryptoshell.input_args(parser)
 	cryptoshell.mode_args(parser)
 	parser.add_argument('-a', '--analyze', type=int, default=75, help='The maximum length of each shift. Defaults to 75. Use 0 for no limit.')
+	parser.add_argument('-n', '--top', type=int, help='Only show this many of the most likely shifts. Defaults to all 25.')
+	parser.add_argument('--corpus', metavar='FILE', type=str,
+		help='Rank the shifts by n-gram fitness, from an index built by fitness.py or a file of English text to count them from. Needs NumPy.')
 	args = parser.parse_args()
 	message = cryptoshell.get_message(args)
 	sign, offset = (1, OFFSET_UPPER) if args.encrypt else (-1, OFFSET_LOWER)
 	max_len = args.analyze or None
-	cryptoshell.write_output('\n'.join(
-		f"{chr(i + OFFSET_UPPER)}:{shift}" for i, shift in 
-		enumerate(analyze(message, max_len, sign, offset), start=1)), args)
+	ngrams = None
+	if args.corpus:
+		if vector is None:
+			parser.error('--corpus requires NumPy')
+		from fitness import NGrams
+		ngrams = NGrams.from_file(args.corpus)
+	print('\n'.join(
+		f"{chr(e + OFFSET_UPPER)}:{shift}" for e, shift in
+		analyze(message, max_len, sign, offset, args.top, ngrams)), end='')
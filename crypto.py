@@ -1,15 +1,19 @@
 import string
-from collections.abc import Callable, Iterable
+import threading
+from collections import Counter, OrderedDict, namedtuple
+from collections.abc import Buffer, Callable, Iterable, Sequence
+from functools import cache
 from itertools import chain, islice
 from os import PathLike
 from string import ascii_letters
 from types import SimpleNamespace
-from typing import Mapping, ParamSpec, Sequence
 
 OFFSET_DIGIT = ord('0')
 OFFSET_UPPER = ord('A')
 OFFSET_LOWER = ord('a')
 FileType = str | bytes | PathLike
+# ciphers kept built by the default CipherCache
+CACHE_SIZE = 256
 
 
 def batched(iterable: Iterable, size: int, pad=None, drop=False):
@@ -27,10 +31,11 @@ def batched(iterable: Iterable, size: int, pad=None, drop=False):
 
 
 class AsciiTranslationTable:
-	__slots__ = ('chars',)
+	__slots__ = ('chars', '_compiled')
 		
 	def __init__(self, chars=None):
 		self.chars = [None] * 127 if chars is None else chars
+		self._compiled = None
 	
 	@classmethod
 	def with_letters(cls, extra=''):
@@ -42,10 +47,34 @@ class AsciiTranslationTable:
 	def allow(self, letters):
 		for c in letters:
 			self.chars[ord(c)] = c
+		self._compiled = None
 
 	def replace(self, letters, replace):
 		for c, d in zip(letters, replace):
 			self.chars[ord(c)] = d
+		self._compiled = None
+
+	def compile(self):
+		"""Builds (and caches) the table and delete set for bytes.translate."""
+		if self._compiled is None:
+			table = bytearray(range(256))
+			delete = bytearray()
+			for c in range(256):
+				d = self.chars[c] if c < 127 else None
+				if d is None:
+					delete.append(c)
+				else:
+					table[c] = ord(d)
+			self._compiled = bytes(table), bytes(delete)
+		return self._compiled
+
+	def translate_bytes(self, data: bytes) -> bytes:
+		return data.translate(*self.compile())
+
+	def translate(self, message: str) -> str:
+		"""Same as message.translate(self), but at C speed. Non-ASCII characters
+		are always deleted, so they are dropped before the bytes are translated."""
+		return self.translate_bytes(message.encode('ascii', 'ignore')).decode('ascii')
 	
 	def __getitem__(self, x):
 		return self.chars[x] if x < 127 else None
@@ -63,16 +92,196 @@ class AsciiTranslationTable:
 
 
 BASIC_TABLE = AsciiTranslationTable.with_letters()
+BASIC_TABLE.compile()
 
 
 def to_code(c: str):
 	return (ord(c) - OFFSET_UPPER) & 0x1F
 
 
-P = ParamSpec('P')
+# to_code for every byte, for bytes.translate
+LETTER_CODES = bytes((c - OFFSET_UPPER) & 0x1F for c in range(256))
+
+
+# Ciphers work on buffers of ASCII codes: bytes, bytearray, memoryview, mmap or
+# anything else with the buffer protocol. Each *_into method writes its output to
+# out, which may be the input itself when the length does not change, or to a
+# new bytearray if out is None, and returns it. The str methods are thin wrappers.
+
+def byte_view(data: Buffer) -> memoryview:
+	"""A flat view of the buffer's bytes. Unlike mmap, indexing it gives ints."""
+	return memoryview(data).cast('B')
+
+
+def output_buffer(out: Buffer | None, length: int) -> Buffer:
+	if out is None:
+		return bytearray(length)
+	if len(byte_view(out)) != length:
+		raise ValueError(f"output buffer must have length {length}")
+	return out
+
+
+def text_call(func: Callable[..., Buffer], message: str, *args, **kwargs) -> str:
+	"""Calls a buffer function on a str message and returns its output as a str."""
+	return str(func(message.encode('ascii'), *args, **kwargs), 'ascii')
+
+
+class BufferCipher:
+	"""Instances are immutable once built, so one can be shared, such as by CipherCache.
+	Any tables a cipher derives from its key are built in __init__, not on first use."""
+	__slots__ = ()
+	# whether *_into take the position where data starts in the message, as
+	# keystream ciphers can, so that any part of a message can be done on its own
+	seekable = False
+
+	@classmethod
+	def create(cls, *args, **options):
+		"""Builds a cipher from its key. CipherCache calls this on a miss."""
+		return cls(*args, **options)
+
+	@classmethod
+	def cache_key(cls, *args, **options):
+		"""What identifies the cipher create would build, given the same arguments.
+		Ciphers override this to normalize keys, so that equivalent keys share an entry."""
+		return args, tuple(sorted(options.items()))
+
+	def encrypt_into(self, data: Buffer, out: Buffer | None = None) -> Buffer:
+		raise NotImplementedError
+
+	def decrypt_into(self, data: Buffer, out: Buffer | None = None) -> Buffer:
+		raise NotImplementedError
+
+	def encrypt(self, message: str) -> str:
+		return text_call(self.encrypt_into, message)
+
+	def decrypt(self, message: str) -> str:
+		return text_call(self.decrypt_into, message)
+
+	def encryptor(self) -> 'CipherStream':
+		"""A stream that encrypts a message given in chunks. Ciphers with other state
+		that carries across chunks override this; the rest buffer the whole message."""
+		return PositionStream(self.encrypt_into) if self.seekable else BufferedStream(self.encrypt_into)
+
+	def decryptor(self) -> 'CipherStream':
+		return PositionStream(self.decrypt_into) if self.seekable else BufferedStream(self.decrypt_into)
+
+
+class CipherStream:
+	"""Enciphers a message given in chunks. Joined together, the outputs of update
+	for each chunk and then of finish are the output for the whole message."""
+	__slots__ = ()
+
+	def update(self, data: Buffer) -> Buffer:
+		raise NotImplementedError
+
+	def finish(self) -> Buffer:
+		return b''
+
+
+class PositionStream(CipherStream):
+	"""For keystream ciphers, where func(data, position=n) enciphers data as if it
+	started at position n of the message, so the only state is the position."""
+	__slots__ = ('func', 'position')
+
+	def __init__(self, func: Callable[..., Buffer]):
+		self.func = func
+		self.position = 0
+
+	def update(self, data: Buffer) -> Buffer:
+		out = self.func(data, position=self.position)
+		self.position += memoryview(data).nbytes
+		return out
+
+
+class BufferedStream(CipherStream):
+	"""For ciphers that need the whole message before they can write anything:
+	holds every chunk until finish."""
+	__slots__ = ('func', 'data')
+
+	def __init__(self, func: Callable[[Buffer], Buffer]):
+		self.func = func
+		self.data = bytearray()
+
+	def update(self, data: Buffer) -> Buffer:
+		self.data += data
+		return b''
+
+	def finish(self) -> Buffer:
+		data, self.data = self.data, bytearray()
+		return self.func(data)
+
+
+CacheInfo = namedtuple('CacheInfo', 'hits misses maxsize currsize')
+
+
+class CipherCache:
+	"""Built ciphers keyed by (cipher class, cache_key), dropping the least recently
+	used beyond maxsize. Building tables such as Playfair's digraphs or Enigma's
+	permutations then happens once per key rather than once per message."""
+
+	def __init__(self, maxsize: int = CACHE_SIZE):
+		self.maxsize = maxsize
+		self.hits = self.misses = 0
+		self._ciphers = OrderedDict()
+		self._lock = threading.Lock()
+
+	def get(self, cls: type[BufferCipher], *args, **options) -> BufferCipher:
+		key = cls, cls.cache_key(*args, **options)
+		with self._lock:
+			cipher = self._ciphers.get(key)
+			if cipher is not None:
+				self._ciphers.move_to_end(key)
+				self.hits += 1
+				return cipher
+			self.misses += 1
+		# built outside the lock; if two threads race, both build and the last one is kept
+		cipher = cls.create(*args, **options)
+		with self._lock:
+			self._ciphers[key] = cipher
+			while len(self._ciphers) > self.maxsize:
+				self._ciphers.popitem(last=False)
+		return cipher
 
-def collect_to_str(func: Callable[P, Iterable[str]]) -> Callable[P, str]:
-	def joiner(*args: P.args, **kwargs: P.kwargs) -> str:
+	def info(self):
+		return CacheInfo(self.hits, self.misses, self.maxsize, len(self._ciphers))
+
+	def clear(self):
+		"""Drops every cipher and resets the counters."""
+		with self._lock:
+			self._ciphers.clear()
+			self.hits = self.misses = 0
+
+
+cipher_cache = CipherCache()
+
+
+def cached(cls: type[BufferCipher], *args, **options) -> BufferCipher:
+	"""The cipher cls.create(*args, **options) would build, from the shared cache."""
+	return cipher_cache.get(cls, *args, **options)
+
+
+# relative frequency of each letter in English text
+ENGLISH_FREQ = (
+	0.08167, 0.01492, 0.02782, 0.04253, 0.12702, 0.02228, 0.02015, 0.06094, 0.06966,
+	0.00153, 0.00772, 0.04025, 0.02406, 0.06749, 0.07507, 0.01929, 0.00095, 0.05987,
+	0.06327, 0.09056, 0.02758, 0.00978, 0.02360, 0.00150, 0.01974, 0.00074)
+
+
+def letter_histogram(message: str):
+	counts = Counter(message)
+	return [counts[a] + counts[b] for a, b in zip(string.ascii_uppercase, string.ascii_lowercase)]
+
+
+def chi_squared(histogram: Sequence[int]):
+	"""Lower is more like English."""
+	total = sum(histogram)
+	if not total:
+		return 0.0
+	return sum((n - total * f) ** 2 / (total * f) for n, f in zip(histogram, ENGLISH_FREQ))
+
+
+def collect_to_str(func: Callable[..., Iterable[str]]) -> Callable[..., str]:
+	def joiner(*args, **kwargs) -> str:
 		it = func(*args, **kwargs)
 		return ''.join(it)
 	return joiner
@@ -114,3 +323,139 @@ class CodeTable:
 
 	def __repr__(self):
 		return f'<CodeTable with {len(self.table)} slots ({chr(self.offset)}..{chr(self.offset + len(self.table) - 1)})>'
+
+
+# a code that no character of an Alphabet has
+INVALID = 0xFF
+
+
+class Alphabet:
+	"""N characters, compiled from their CodeTable for ciphers mod N, and accepted
+	in either case. encode maps every byte to its code, or INVALID, and upper and
+	lower map codes back to ASCII, for ciphertext and plaintext. Each is a table
+	for bytes.translate, which also works as an array for lookups."""
+	__slots__ = ('chars', 'encode', 'upper', 'lower', 'text_filter')
+
+	def __init__(self, chars: str):
+		chars = chars.upper()
+		if not chars.isascii() or not 0 < len(chars) < INVALID or len(set(chars)) != len(chars):
+			raise ValueError(f"alphabet must have 1 to {INVALID - 1} different ASCII characters: {chars!r}")
+		table = CodeTable.from_alphabet_ignore_case(chars)
+		encode = bytearray([INVALID]) * 256
+		for i, code in enumerate(table.table):
+			if code is not None:
+				encode[table.offset + i] = code
+		self.chars = chars
+		self.encode = bytes(encode)
+		self.upper = chars.encode('ascii').ljust(256, b'\0')
+		self.lower = chars.lower().encode('ascii').ljust(256, b'\0')
+		self.text_filter = AsciiTranslationTable()
+		self.text_filter.allow(chars + chars.lower())
+		self.text_filter.compile()
+
+	def __len__(self):
+		return len(self.chars)
+
+	def __repr__(self):
+		return f"Alphabet({self.chars!r})"
+
+	def __reduce__(self):
+		# one instance per alphabet in each process, which also shares its tables
+		return get_alphabet, (self.chars,)
+
+	def codes(self, data: str | Buffer) -> bytes:
+		"""The code of each character, raising ValueError for any not in the alphabet."""
+		data = data.encode('ascii') if isinstance(data, str) else byte_view(data).tobytes()
+		codes = data.translate(self.encode)
+		if INVALID in codes:
+			raise ValueError(f"not in the alphabet {self.chars!r}: {chr(data[codes.index(INVALID)])!r}")
+		return codes
+
+	# the tables below are kept, since keys reuse the same few
+
+	@cache
+	def negation(self) -> bytes:
+		"""A bytes.translate table that maps each code c to -c mod N."""
+		return bytes(-c % len(self) for c in range(256))
+
+	@cache
+	def mod_table(self, decode: bytes) -> bytes:
+		"""A bytes.translate table that maps each byte v to decode[v % N], so that
+		sums of codes below 256 are taken mod N and decoded in one pass."""
+		return bytes(decode[v % len(self)] for v in range(256))
+
+	@cache
+	def table(self, mult: int, add: int, decode: bytes) -> bytes:
+		"""A bytes.translate table that maps the character with code c to
+		decode[(mult * c + add) % N], such as upper or lower. Bytes not in the
+		alphabet map to 0."""
+		n = len(self)
+		return bytes(decode[(mult * c + add) % n] if c != INVALID else 0 for c in self.encode)
+
+
+LETTERS = Alphabet(string.ascii_uppercase)
+
+# alphabets by name, for keys (see keygen) and for the ciphers that work in any alphabet
+ALPHABETS = {
+	'25': string.ascii_uppercase.replace('J', ''),
+	'26': string.ascii_uppercase,
+	'29': string.ascii_uppercase + ' ,.',
+	'36': string.ascii_uppercase + string.digits,
+}
+
+
+def get_alphabet(name: Alphabet | str) -> Alphabet:
+	"""The alphabet with the given name in ALPHABETS, or else with the given characters.
+	There is one instance of each. An Alphabet is returned as it is."""
+	if isinstance(name, Alphabet):
+		return name
+	return _alphabet(ALPHABETS.get(name, name).upper())
+
+
+@cache
+def _alphabet(chars: str):
+	return LETTERS if chars == LETTERS.chars else Alphabet(chars)
+
+
+# what python -m crypto runs: each command is the module of the same name run
+# as a script, which is imported only when it is the one asked for
+COMMANDS = {
+	'caesar': 'tries every Caesar shift of a message',
+	'vigenere': 'the Vigenère cipher, and solving it',
+	'autokey': 'the autokey cipher',
+	'playfair': 'the Playfair cipher, and solving it',
+	'adfgvx': 'the ADFGVX cipher, and solving it',
+	'greenwall': 'the Greenwall cipher',
+	'enigma': 'the Enigma machine, and finding its settings from a crib',
+	'keygen': 'random keys for the ciphers',
+	'fitness': 'builds an n-gram index for scoring decryptions',
+	'daemon': 'a daemon that keeps ciphers built between runs',
+	'benchmark': 'measures the speed of every cipher',
+}
+
+
+def main(argv: list[str]):
+	import runpy
+	import sys
+
+	if not argv or argv[0] in ('-h', '--help'):
+		file = sys.stdout if argv else sys.stderr
+		print('usage: python -m crypto COMMAND [ARGS...]\n\ncommands:', file=file)
+		for name, summary in COMMANDS.items():
+			print(f"  {name:10} {summary}", file=file)
+		print('\nRun python -m crypto COMMAND --help for the arguments of each.', file=file)
+		return 0 if argv else 2
+	name, *rest = argv
+	if name not in COMMANDS:
+		print(f"unknown command: {name} (choose from {', '.join(COMMANDS)})", file=sys.stderr)
+		return 2
+	sys.argv = [sys.argv[0], *rest]
+	# alter_sys makes the command __main__, so that the worker processes of its pools can find what it defines
+	runpy.run_module(name, run_name='__main__', alter_sys=True)
+	return 0
+
+
+if __name__ == '__main__':
+	import sys
+
+	sys.exit(main(sys.argv[1:]))
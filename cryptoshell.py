@@ -1,9 +1,48 @@
+from __future__ import annotations
+
+import io
+import json
+import os
+import re
+import stat
 import sys
+import time
 
 from argparse import ArgumentParser, Namespace
-from collections.abc import Callable
+from collections import deque
+from collections.abc import Buffer, Callable
+from contextlib import contextmanager
+from itertools import accumulate, islice
+
+from crypto import ALPHABETS, BASIC_TABLE, AsciiTranslationTable, BufferCipher, BufferedStream, CipherStream
+
+# typing takes a while to import and is only needed by type checkers, which treat this name as True
+TYPE_CHECKING = False
+if TYPE_CHECKING:
+	from multiprocessing.shared_memory import SharedMemory
+	from typing import BinaryIO
+
+try:
+	import resource
+except ImportError:
+	resource = None
+
+_LETTER = re.compile(rb'[A-Za-z]')
+
+# records sent to a batch worker at a time
+BATCH_CHUNK = 1024
+# chunks waiting per batch worker, which bounds the memory a batch holds
+BATCH_PENDING = 4
 
-from crypto import BASIC_TABLE, AsciiTranslationTable
+# bytes read at a time in stream mode
+STREAM_CHUNK = 1 << 20
+# with --jobs, seekable ciphers split a message into ranges of this many bytes for the workers
+PARALLEL_CHUNK = 1 << 24
+# and below this many bytes, it is done in one process after all
+PARALLEL_MIN = 1 << 22
+
+# where the cipher daemon (see daemon.py) listens, unless CRYPTO_SOCKET says otherwise
+DAEMON_SOCKET = 'crypto-daemon.sock'
 
 MODE_HELP = 'A message starting with a lower-case letter is assumed plaintext to be encrypted (with upper-case output), and the inverse is also true. Encrypt/decrypt can be forced with optional flags.'
 
@@ -19,38 +58,607 @@ def mode_args(parser: ArgumentParser):
 	mode_group.add_argument('-d', '--decrypt', action='store_true', help='decrypt mode')
 
 
+def alphabet_args(parser: ArgumentParser):
+	parser.add_argument('-A', '--alphabet', type=str,
+		help=f"the alphabet to work in, mod its length: one of {', '.join(ALPHABETS)} (see keygen.py), or its characters. Defaults to the 26 letters.")
+
+
+def batch_args(parser: ArgumentParser):
+	group = parser.add_argument_group('batch mode')
+	group.add_argument('--batch', nargs='?', const='lines', choices=('lines', 'jsonl'),
+		help='Process many messages from stdin, one per line, writing one result per line in the same order. With jsonl, each line is an object with a "message" and optionally a "key" (which replaces the one given in the arguments) and a "mode" ("encrypt" or "decrypt"), and each result is an object with a "result" or an "error". Without it, a message that fails gives a line starting "error: ".')
+	group.add_argument('--jobs', type=int, default=1,
+		help='the number of batch workers, or without --batch, of processes to split a long message between, for ciphers that can (default: 1)')
+	group.add_argument('--threads', action='store_true',
+		help='run batch workers as threads rather than processes')
+
+
+def stream_args(parser: ArgumentParser):
+	parser.add_argument('--stream', nargs='?', const=STREAM_CHUNK, type=int, metavar='BYTES',
+		help='Read the message in chunks of this many bytes (default: 1048576), writing the output as it goes, so that any size of input runs in constant memory. Ciphers that need the whole message first, such as ADFGVX, hold it until the end.')
+
+
+def stats_args(parser: ArgumentParser):
+	group = parser.add_argument_group('instrumentation')
+	group.add_argument('--stats', nargs='?', const='text', choices=('text', 'json'),
+		help='report the time and throughput of each phase of the run, and peak memory, to stderr')
+	group.add_argument('--profile', nargs='?', const=25, type=int, metavar='LINES',
+		help='profile the cipher phase and show the top functions by cumulative time on stderr (default: 25)')
+
+
+# the character count each phase's throughput is measured by
+PHASE_COUNTS = {'read': 'input', 'filter': 'input', 'probe': 'filtered', 'cipher': 'filtered', 'write': 'output'}
+
+
+class Stats:
+	"""Times the phases of a run and counts characters. Phases are always timed,
+	which is cheap; only an enabled instance reports them, in emit."""
+
+	def __init__(self, enabled: bool = False, as_json: bool = False, profile: int = 0):
+		self.enabled = enabled
+		self.as_json = as_json
+		self.profile = profile
+		self.times: dict[str, int] = {}
+		self.counts: dict[str, int] = {}
+		self.profiler: cProfile.Profile | None = None
+
+	@classmethod
+	def from_args(cls, args: Namespace):
+		stats = getattr(args, 'stats', None)
+		profile = getattr(args, 'profile', None) or 0
+		return cls(bool(stats or profile), stats == 'json', profile)
+
+	@contextmanager
+	def phase(self, name: str, profile: bool = False):
+		"""Times the block as the named phase. With profile, it is also profiled if profiling was asked for."""
+		if profile and self.profile:
+			# a phase run many times, such as for each chunk of a stream, adds to one profile
+			import cProfile
+			self.profiler = self.profiler or cProfile.Profile()
+			self.profiler.enable()
+		start = time.perf_counter_ns()
+		try:
+			yield
+		finally:
+			self.times[name] = self.times.get(name, 0) + time.perf_counter_ns() - start
+			if profile and self.profiler:
+				self.profiler.disable()
+
+	def count(self, name: str, chars: int):
+		self.counts[name] = chars
+
+	def report(self):
+		phases = {}
+		for name, ns in self.times.items():
+			phase = phases[name] = {'ns': ns}
+			chars = self.counts.get(PHASE_COUNTS.get(name))
+			if chars is not None:
+				phase['chars'] = chars
+				phase['chars_per_sec'] = chars * 1e9 / ns if ns else None
+		return {
+			'phases': phases,
+			'total_ns': sum(self.times.values()),
+			'counts': dict(self.counts),
+			'peak_rss_bytes': peak_rss(),
+		}
+
+	def emit(self, file=None):
+		if not self.enabled:
+			return
+		file = file or sys.stderr
+		report = self.report()
+		if self.as_json:
+			print(json.dumps(report), file=file)
+		else:
+			for name, phase in report['phases'].items():
+				rate = phase.get('chars_per_sec')
+				print(f"{name:8} {phase['ns'] / 1e6:10.3f} ms"
+					+ (f" {phase['chars']:12} chars {rate / 1e6:10.2f} Mchar/s" if rate else ''), file=file)
+			print(f"{'total':8} {report['total_ns'] / 1e6:10.3f} ms", file=file)
+			if report['counts']:
+				print(', '.join(f"{name} {n} chars" for name, n in report['counts'].items()), file=file)
+			if report['peak_rss_bytes'] is not None:
+				print(f"peak RSS {report['peak_rss_bytes'] / (1 << 20):.1f} MB", file=file)
+		if self.profiler:
+			import pstats
+			pstats.Stats(self.profiler, stream=file).sort_stats('cumulative').print_stats(self.profile)
+
+
+def peak_rss():
+	"""The most memory the process has held, in bytes, or None where this is not available."""
+	if resource is None:
+		return None
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	# macOS reports bytes, Linux kilobytes
+	return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def daemon_args(parser: ArgumentParser):
+	parser.add_argument('--local', action='store_true',
+		help='run here even if a cipher daemon is running (see daemon.py)')
+
+
+def daemon_socket():
+	path = os.environ.get('CRYPTO_SOCKET')
+	if path:
+		return path
+	runtime = os.environ.get('XDG_RUNTIME_DIR')
+	if not runtime:
+		import tempfile
+		# anyone can make files in the temporary directory, so the socket goes in a directory of the user's own
+		runtime = os.path.join(tempfile.gettempdir(), f"crypto-{os.getuid()}")
+	return os.path.join(runtime, DAEMON_SOCKET)
+
+
+def private_socket(path: str):
+	"""Whether path is a socket of this user's that no one else can connect to,
+	so a daemon of theirs rather than one anyone could have started there."""
+	try:
+		info = os.stat(path)
+	except OSError:
+		return False
+	return stat.S_ISSOCK(info.st_mode) and info.st_uid == os.getuid() and not info.st_mode & 0o077
+
+
+class DaemonClient:
+	"""A connection to a cipher daemon, which can carry any number of requests."""
+
+	def __init__(self, path: str | None = None):
+		import socket
+		if not hasattr(socket, 'AF_UNIX'):
+			raise OSError('Unix sockets are not supported here')
+		self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		try:
+			self.sock.connect(path or daemon_socket())
+		except OSError:
+			self.sock.close()
+			raise
+		self.file = self.sock.makefile('rwb')
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+	def close(self):
+		self.file.close()
+		self.sock.close()
+
+	def request(self, cipher: str, key, message: str | bytes, mode: str | None = None, options: dict | None = None) -> str:
+		"""Returns the daemon's result. Errors from the daemon are raised as ValueError."""
+		if not isinstance(message, str):
+			message = bytes(message).decode('ascii', 'ignore')
+		request = {'cipher': cipher, 'key': key, 'message': message}
+		if mode:
+			request['mode'] = mode
+		if options:
+			request['options'] = options
+		self.file.write(json.dumps(request).encode('ascii') + b'\n')
+		self.file.flush()
+		line = self.file.readline()
+		if not line:
+			raise ConnectionError('the daemon closed the connection')
+		response = json.loads(line)
+		if 'error' in response:
+			raise ValueError(response['error'])
+		return response['result']
+
+
+def forward(args: Namespace, cipher: str, key, options: dict | None = None):
+	"""Runs the cipher on a daemon, if one is running, instead of here. Returns
+	whether it did. Call it before building the cipher, which the daemon has warm."""
+	if args.local or any(getattr(args, name, None) for name in ('batch', 'stream', 'stats', 'profile')):
+		return False
+	if getattr(args, 'jobs', 1) > 1 or not hasattr(os, 'getuid'):
+		return False
+	# most runs have no daemon, and this saves them importing socket
+	path = daemon_socket()
+	if not private_socket(path):
+		return False
+	message = read_message(args)
+	mode = 'encrypt' if args.encrypt else 'decrypt' if args.decrypt else None
+	try:
+		with DaemonClient(path) as client:
+			result = client.request(cipher, key, message, mode, options)
+	except OSError:
+		# the daemon went away, or was never there; read_message hands the message back for running here
+		return False
+	sys.stdout.write(result)
+	return True
+
+
 def get_message(args: Namespace):
+	return _read(args, sys.stdin)
+
+
+def read_message(args: Namespace) -> bytes:
+	"""Like get_message, but as bytes straight from stdin, without decoding.
+	Reads once, returning the same message when called again."""
+	message = getattr(args, 'read_message', None)
+	if message is None:
+		message = _read(args, sys.stdin.buffer)
+		args.read_message = message = message.encode('UTF-8') if isinstance(message, str) else message
+	return message
+
+
+def _read(args: Namespace, stdin):
 	has_stdin = not sys.stdin.isatty()	
 	if args.message is not None:
 		if has_stdin:
 			raise ValueError('Messaged passed through both stdin and args.')
 		return args.message
 	if has_stdin:
-		return sys.stdin.read()
+		return stdin.read()
 	raise ValueError('No message passed through stdin or args.')
 
 
-def probe_text(s: str):
-	for c in s:
-		if c.isalpha():
-			return c.islower()
-	return True
+def probe_text(s: str | Buffer):
+	if isinstance(s, str):
+		s = s.encode('ascii', 'ignore')
+	match = _LETTER.search(s)
+	return match is None or match.group().islower()
 
 
 def run_cipher(
 	args: Namespace,
-	encrypt: Callable[[str], str],
-	decrypt: Callable[[str], str],
+	encrypt: Callable[[bytes], Buffer],
+	decrypt: Callable[[bytes], Buffer],
 	text_filter: AsciiTranslationTable = BASIC_TABLE,
-	probe_func: Callable[[str], bool] = probe_text):
+	probe_func: Callable[[bytes], bool] = probe_text,
+	message: bytes | str | BinaryIO | None = None,
+	cipher_for: Callable[[str], BufferCipher] | None = None,
+	stats: Stats | None = None,
+	cipher: BufferCipher | None = None):
+	"""The cipher functions take and return buffers of ASCII codes (see crypto.BufferCipher).
+	message, if given, is used instead of the arguments and stdin, and may be a binary file.
+	cipher_for makes a cipher from a key, for batch records that have their own.
+	stats (by default, one set up from args) times each phase; pass one in to
+	include phases from before the call, such as making the cipher.
+	cipher, if given, provides the streams for stream mode, which otherwise
+	holds the whole message for the cipher functions."""
+
+	if stats is None:
+		stats = Stats.from_args(args)
+
+	if getattr(args, 'stream', None):
+		if getattr(args, 'batch', None):
+			raise ValueError('--stream cannot be used with --batch')
+		if cipher is not None:
+			streams = cipher.encryptor, cipher.decryptor
+		else:
+			streams = lambda: BufferedStream(encrypt), lambda: BufferedStream(decrypt)
+		run_stream(args, *streams, _source(args, message), text_filter, probe_func, stats)
+		return
 
-	message = get_message(args).translate(text_filter)
+	if getattr(args, 'jobs', 1) > 1 and not getattr(args, 'batch', None) and cipher is not None and cipher.seekable:
+		run_parallel(args, cipher, _source(args, message), text_filter, probe_func, stats)
+		return
+
+	if getattr(args, 'batch', None):
+		force = 'encrypt' if args.encrypt else 'decrypt' if args.decrypt else None
+		batch = Batch(encrypt, decrypt, text_filter, probe_func, cipher_for, args.batch == 'jsonl', force)
+		with stats.phase('batch', profile=True):
+			run_batch(batch, args.jobs, args.threads)
+		stats.emit()
+		return
+
+	with stats.phase('read'):
+		if message is None:
+			message = read_message(args)
+		elif isinstance(message, str):
+			message = message.encode('UTF-8')
+		elif hasattr(message, 'read'):
+			message = message.read()
+	if 'input' not in stats.counts:
+		stats.count('input', len(message))
+	with stats.phase('filter'):
+		message = text_filter.translate_bytes(message)
+	stats.count('filtered', len(message))
 
 	if args.encrypt:
 		mode = encrypt
 	elif args.decrypt:
 		mode = decrypt
 	else:
-		mode = encrypt if probe_func(message) else decrypt
+		with stats.phase('probe'):
+			mode = encrypt if probe_func(message) else decrypt
+
+	with stats.phase('cipher', profile=True):
+		result = mode(message)
+	stats.count('output', len(result))
+	with stats.phase('write'):
+		sys.stdout.buffer.write(result)
+		sys.stdout.buffer.flush()
+	stats.emit()
+
+
+def _source(args: Namespace, message: bytes | str | BinaryIO | None) -> BinaryIO:
+	"""The message as a binary file, which is stdin.buffer itself unless the message is elsewhere."""
+	if message is None:
+		if args.message is None and not sys.stdin.isatty():
+			return sys.stdin.buffer
+		message = _read(args, sys.stdin.buffer)
+	if hasattr(message, 'read'):
+		return message
+	return io.BytesIO(message.encode('UTF-8') if isinstance(message, str) else message)
+
+
+def run_stream(
+	args: Namespace,
+	encryptor: Callable[[], CipherStream],
+	decryptor: Callable[[], CipherStream],
+	source: BinaryIO,
+	text_filter: AsciiTranslationTable = BASIC_TABLE,
+	probe_func: Callable[[bytes], bool] = probe_text,
+	stats: Stats | None = None):
+	"""Runs the cipher on source args.stream bytes at a time, writing the output as
+	it goes. Without -e or -d, the mode is probed from the first chunk with any text."""
+	if stats is None:
+		stats = Stats.from_args(args)
+	if args.encrypt or args.decrypt:
+		stream = encryptor() if args.encrypt else decryptor()
+	else:
+		stream = None
+	out = sys.stdout.buffer
+	read = filtered = written = 0
+	while True:
+		with stats.phase('read'):
+			chunk = source.read(args.stream)
+		if not chunk:
+			break
+		read += len(chunk)
+		with stats.phase('filter'):
+			chunk = text_filter.translate_bytes(chunk)
+		filtered += len(chunk)
+		if stream is None:
+			if not chunk:
+				continue
+			with stats.phase('probe'):
+				stream = encryptor() if probe_func(chunk) else decryptor()
+		with stats.phase('cipher', profile=True):
+			result = stream.update(chunk)
+		written += len(result)
+		with stats.phase('write'):
+			out.write(result)
+	if stream is None:
+		stream = encryptor() if probe_func(b'') else decryptor()
+	with stats.phase('cipher', profile=True):
+		result = stream.finish()
+	written += len(result)
+	with stats.phase('write'):
+		out.write(result)
+		out.flush()
+	stats.count('input', read)
+	stats.count('filtered', filtered)
+	stats.count('output', written)
+	stats.emit()
+
+
+# the cipher and text filter, in each parallel worker
+_parallel = None
+
+
+def _init_parallel(cipher: BufferCipher, text_filter: AsciiTranslationTable):
+	global _parallel
+	_parallel = cipher, text_filter
+
+
+def _filter_range(name: str, start: int, end: int):
+	"""Filters a range of the shared message in place, moving what is left to the start of the range. Returns its length."""
+	from multiprocessing.shared_memory import SharedMemory
+	shm = SharedMemory(name)
+	try:
+		with shm.buf[start:end] as view:
+			text = _parallel[1].translate_bytes(view.tobytes())
+			view[:len(text)] = text
+		return len(text)
+	finally:
+		shm.close()
+
+
+def _cipher_range(name: str, start: int, length: int, position: int, decrypting: bool):
+	from multiprocessing.shared_memory import SharedMemory
+	shm = SharedMemory(name)
+	try:
+		with shm.buf[start:start + length] as view:
+			cipher = _parallel[0]
+			(cipher.decrypt_into if decrypting else cipher.encrypt_into)(view, view, position=position)
+	finally:
+		shm.close()
+
+
+def _read_shared(source: BinaryIO):
+	"""Reads the whole source into new shared memory, straight from the file when it is one."""
+	from multiprocessing.shared_memory import SharedMemory
+	try:
+		info = os.fstat(source.fileno())
+		size = info.st_size - source.tell() if stat.S_ISREG(info.st_mode) else None
+	except (OSError, io.UnsupportedOperation):
+		size = None
+	data = source.read() if size is None else None
+	if data is not None:
+		size = len(data)
+	# shared memory cannot be empty
+	shm = SharedMemory(create=True, size=max(size, 1))
+	with shm.buf[:size] as view:
+		if data is not None:
+			view[:] = data
+		else:
+			filled = 0
+			while filled < size and (n := source.readinto(view[filled:])):
+				filled += n
+			size = filled
+	return shm, size
+
+
+def run_parallel(
+	args: Namespace,
+	cipher: BufferCipher,
+	source: BinaryIO,
+	text_filter: AsciiTranslationTable = BASIC_TABLE,
+	probe_func: Callable[[bytes], bool] = probe_text,
+	stats: Stats | None = None):
+	"""Runs a seekable cipher on the message across args.jobs processes. The message
+	is read into shared memory, where each worker filters and then ciphers its own
+	ranges in place, ciphering from the position the range starts at in the filtered
+	message. Nothing but the offsets is sent to the workers."""
+	if stats is None:
+		stats = Stats.from_args(args)
+	with stats.phase('read'):
+		shm, size = _read_shared(source)
+	try:
+		decrypting = args.decrypt if args.encrypt or args.decrypt else None
+		ranges = cipher_shared(shm, size, cipher, args.jobs, text_filter, decrypting, probe_func, stats)
+		with stats.phase('write'):
+			for start, length in ranges:
+				with shm.buf[start:start + length] as view:
+					sys.stdout.buffer.write(view)
+			sys.stdout.buffer.flush()
+	finally:
+		shm.close()
+		shm.unlink()
+	filtered = sum(length for _, length in ranges)
+	stats.count('input', size)
+	stats.count('filtered', filtered)
+	stats.count('output', filtered)
+	stats.emit()
+
+
+def cipher_shared(
+	shm: SharedMemory,
+	size: int,
+	cipher: BufferCipher,
+	jobs: int,
+	text_filter: AsciiTranslationTable = BASIC_TABLE,
+	decrypting: bool | None = None,
+	probe_func: Callable[[bytes], bool] = probe_text,
+	stats: Stats | None = None,
+	min_size: int = PARALLEL_MIN,
+	chunk: int = PARALLEL_CHUNK) -> list[tuple[int, int]]:
+	"""The work of run_parallel on the first size bytes of shm: filters and ciphers
+	them in place across jobs processes, in ranges of chunk bytes, decrypting if
+	probe_func finds no plaintext when decrypting is None. Below min_size, it is all
+	done in this process. Returns the start and length of what is left of each
+	range, in order."""
+	stats = stats or Stats()
+	starts = range(0, size, chunk)
+	ends = [min(start + chunk, size) for start in starts]
+	names = [shm.name] * len(starts)
+	if size >= min_size:
+		from concurrent.futures import ProcessPoolExecutor
+		pool = ProcessPoolExecutor(jobs, initializer=_init_parallel, initargs=(cipher, text_filter))
+	else:
+		_init_parallel(cipher, text_filter)
+		pool = None
+	run = pool.map if pool else map
+	try:
+		with stats.phase('filter'):
+			lengths = list(run(_filter_range, names, starts, ends))
+		if decrypting is None:
+			with stats.phase('probe'):
+				# the first range with any text left
+				start, length = next(((s, n) for s, n in zip(starts, lengths) if n), (0, 0))
+				with shm.buf[start:start + length] as view:
+					decrypting = not probe_func(view)
+		positions = [0, *accumulate(lengths)][:-1]
+		with stats.phase('cipher', profile=True):
+			list(run(_cipher_range, names, starts, lengths, positions, [decrypting] * len(starts)))
+	finally:
+		if pool:
+			pool.shutdown()
+	return list(zip(starts, lengths))
+
+
+class Batch:
+	"""What a batch worker needs to process records. It must be picklable to go to worker processes."""
+
+	def __init__(self, encrypt, decrypt, text_filter, probe_func, cipher_for, jsonl: bool, force: str | None):
+		self.modes = {'encrypt': encrypt, 'decrypt': decrypt}
+		self.text_filter = text_filter
+		self.probe_func = probe_func
+		self.cipher_for = cipher_for
+		self.jsonl = jsonl
+		self.force = force
+
+	def _modes(self, key: str | None):
+		if key is None:
+			return self.modes
+		if self.cipher_for is None:
+			raise ValueError('this cipher does not take a key per record')
+		cipher = self.cipher_for(key)
+		return {'encrypt': cipher.encrypt_into, 'decrypt': cipher.decrypt_into}
 
-	print(mode(message), end='')
+	def run(self, message: bytes, key: str | None = None, mode: str | None = None):
+		modes = self._modes(key)
+		message = self.text_filter.translate_bytes(message)
+		mode = mode or self.force or ('encrypt' if self.probe_func(message) else 'decrypt')
+		if mode not in modes:
+			raise ValueError(f"unknown mode: {mode}")
+		return modes[mode](message)
+
+	def _run_record(self, line: bytes):
+		try:
+			record = json.loads(line)
+			if not isinstance(record, dict) or not isinstance(record.get('message'), str):
+				raise ValueError('record has no message')
+			result = self.run(record['message'].encode('UTF-8'), record.get('key'), record.get('mode'))
+			return json.dumps({'result': str(result, 'ascii')}).encode('ascii')
+		except ValueError as e:
+			return json.dumps({'error': str(e)}).encode('ascii')
+		except Exception as e:
+			# a bad record gets its error, and the rest of the batch carries on
+			return json.dumps({'error': f"{type(e).__name__}: {e}"}).encode('ascii')
+
+	def _run_line(self, line: bytes):
+		try:
+			return self.run(line.rstrip(b'\r\n'))
+		except Exception as e:
+			# results are letters, so this cannot be mistaken for one
+			return f"error: {e}".encode('ascii', 'replace')
+
+	def process(self, lines: list[bytes]) -> bytes:
+		if self.jsonl:
+			results = [self._run_record(line) for line in lines]
+		else:
+			results = [self._run_line(line) for line in lines]
+		results.append(b'')
+		return b'\n'.join(results)
+
+
+_worker_batch: Batch | None = None
+
+def _init_worker(batch: Batch):
+	global _worker_batch
+	_worker_batch = batch
+
+
+def _process_in_worker(lines: list[bytes]):
+	return _worker_batch.process(lines)
+
+
+def run_batch(batch: Batch, jobs: int = 1, threads: bool = False):
+	"""Processes stdin a chunk of lines at a time, writing the results in order.
+	Only a few chunks per worker are in flight at once, however long the input."""
+	lines = iter(sys.stdin.buffer)
+	chunks = iter(lambda: list(islice(lines, BATCH_CHUNK)), [])
+	write = sys.stdout.buffer.write
+	if jobs <= 1:
+		for chunk in chunks:
+			write(batch.process(chunk))
+		return
+	from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+	if threads:
+		pool = ThreadPoolExecutor(jobs)
+		process = batch.process
+	else:
+		pool = ProcessPoolExecutor(jobs, initializer=_init_worker, initargs=(batch,))
+		process = _process_in_worker
+	with pool:
+		pending = deque()
+		for chunk in chunks:
+			if len(pending) >= BATCH_PENDING * jobs:
+				write(pending.popleft().result())
+			pending.append(pool.submit(process, chunk))
+		while pending:
+			write(pending.popleft().result())
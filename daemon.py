@@ -0,0 +1,157 @@
+import asyncio
+import json
+import math
+import os
+import signal
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import adfgvx
+import autokey
+import enigma
+import greenwall
+import playfair
+import vigenere
+from crypto import BASIC_TABLE, Alphabet, batched, cached
+from cryptoshell import DaemonClient, daemon_socket, probe_text
+
+# messages at least this long go to the process pool, so short ones are not stuck behind them
+OFFLOAD_LEN = 1 << 16
+# the longest request line, which holds the whole message
+LINE_LIMIT = 1 << 30
+
+
+def _adfgvx(keyword: str, grid: str, coord: str | None = None, pad: str = 'X'):
+	grid = adfgvx.TEXT_FILTER.translate(grid)
+	side = math.isqrt(len(grid))
+	if side * side != len(grid):
+		raise ValueError(f"grid must be a square but had length {len(grid)}")
+	coord = coord or {6: 'ADFGVX', 5: 'ADFGX'}.get(side)
+	if not coord:
+		raise ValueError(f"coordinates must be given for a {side}x{side} grid")
+	return cached(adfgvx.Adfgvx, list(batched(grid, side)), keyword, coord, pad)
+
+
+def _greenwall(key: list[str]):
+	horizontal, vertical = key
+	return cached(greenwall.Greenwall, horizontal, vertical)
+
+
+def _enigma(key: dict):
+	return cached(enigma.Enigma, **key)
+
+
+def _cached(cls):
+	return lambda key, **options: cached(cls, key, **options)
+
+
+# name: (gets a cipher from a key and options, built or from crypto.cipher_cache in each process; text filter)
+CIPHERS = {
+	'vigenere': (_cached(vigenere.Vigenere), BASIC_TABLE),
+	'autokey': (_cached(autokey.Autokey), BASIC_TABLE),
+	'playfair': (_cached(playfair.Playfair), BASIC_TABLE),
+	'adfgvx': (_adfgvx, adfgvx.TEXT_FILTER),
+	# the key is [horizontal, vertical]
+	'greenwall': (_greenwall, greenwall.TEXT_FILTER),
+	# the key is an object of Enigma's arguments, with rotors by name
+	'enigma': (_enigma, BASIC_TABLE),
+}
+
+def get_cipher(name: str, key, options: dict):
+	if name not in CIPHERS:
+		raise ValueError(f"unknown cipher: {name}")
+	get, text_filter = CIPHERS[name]
+	cipher = get(key, **options)
+	# ciphers that take an alphabet keep all of its characters
+	alphabet = getattr(cipher, 'alphabet', None)
+	return cipher, alphabet.text_filter if isinstance(alphabet, Alphabet) else text_filter
+
+
+def process(name: str, key, options: dict, mode: str | None, message: str) -> str:
+	cipher, text_filter = get_cipher(name, key, options)
+	data = text_filter.translate_bytes(message.encode('UTF-8'))
+	if mode is None:
+		mode = 'encrypt' if probe_text(data) else 'decrypt'
+	if mode == 'encrypt':
+		return str(cipher.encrypt_into(data), 'ascii')
+	if mode == 'decrypt':
+		return str(cipher.decrypt_into(data), 'ascii')
+	raise ValueError(f"unknown mode: {mode}")
+
+
+async def _respond(line: bytes, pool: ProcessPoolExecutor):
+	try:
+		request = json.loads(line)
+		if not isinstance(request, dict) or not isinstance(request.get('message'), str):
+			raise ValueError('request has no message')
+		args = (request.get('cipher'), request.get('key'), request.get('options') or {},
+			request.get('mode'), request['message'])
+		if len(request['message']) >= OFFLOAD_LEN:
+			result = await asyncio.get_running_loop().run_in_executor(pool, process, *args)
+		else:
+			result = process(*args)
+		return json.dumps({'result': result}).encode('ascii') + b'\n'
+	except ValueError as e:
+		return json.dumps({'error': str(e)}).encode('ascii') + b'\n'
+	except Exception as e:
+		# any request, however broken, gets its answer, and the connection stays up
+		return json.dumps({'error': f"{type(e).__name__}: {e}"}).encode('ascii') + b'\n'
+
+
+async def _handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, pool: ProcessPoolExecutor):
+	# requests on one connection are answered in order; other connections carry on meanwhile
+	try:
+		while line := await reader.readline():
+			writer.write(await _respond(line, pool))
+			await writer.drain()
+	except (ConnectionError, asyncio.LimitOverrunError, ValueError):
+		pass
+	finally:
+		writer.close()
+
+
+async def serve(path: str, workers: int | None = None):
+	if os.path.exists(path):
+		try:
+			DaemonClient(path).close()
+		except OSError:
+			# a socket left behind by a daemon that did not shut down cleanly
+			os.remove(path)
+		else:
+			raise RuntimeError(f"a daemon is already running on {path}")
+	directory = os.path.dirname(path)
+	if directory:
+		os.makedirs(directory, mode=0o700, exist_ok=True)
+	with ProcessPoolExecutor(workers) as pool:
+		# the socket is created private, rather than made so after others could connect
+		umask = os.umask(0o177)
+		try:
+			server = await asyncio.start_unix_server(
+				lambda reader, writer: _handle(reader, writer, pool), path, limit=LINE_LIMIT)
+		finally:
+			os.umask(umask)
+		stop = asyncio.Event()
+		loop = asyncio.get_running_loop()
+		for sig in (signal.SIGINT, signal.SIGTERM):
+			loop.add_signal_handler(sig, stop.set)
+		try:
+			async with server:
+				await stop.wait()
+		finally:
+			os.remove(path)
+
+
+if __name__ == '__main__':
+	import argparse
+
+	parser = argparse.ArgumentParser(
+		description='Runs a cipher daemon on a Unix socket, keeping ciphers built between requests. While it runs, the cipher tools send their work to it (unless given --local). Each request is a line of JSON like {"cipher": "playfair", "key": "KEYWORD", "message": "...", "mode": "encrypt", "options": {...}}, where mode and options are optional, and each response is a line of JSON with a "result" or an "error".')
+	parser.add_argument('-s', '--socket', type=str,
+		help='the socket path. Defaults to $CRYPTO_SOCKET, or crypto-daemon.sock in $XDG_RUNTIME_DIR or in a private directory in the temporary directory. The tools only use a socket that the user owns and no one else can connect to.')
+	parser.add_argument('-w', '--workers', type=int,
+		help='the number of processes for long messages. Defaults to one per CPU.')
+	args = parser.parse_args()
+
+	path = args.socket or daemon_socket()
+	print(f"listening on {path}", file=sys.stderr)
+	asyncio.run(serve(path, args.workers))
@@ -1,29 +1,447 @@
-import sys
-import argparse
+from collections.abc import Buffer, Sequence
+from string import ascii_uppercase
 
-parser = argparse.ArgumentParser(
-	prog='enigma',
-	description='Encrypts a message using the Enigma Machine.')
-input_group = parser.add_mutually_exclusive_group(required=True)
-input_group.add_argument('message', nargs='?', type=str, help='the text of the message')
-input_group.add_argument('-in', metavar='FILE', dest='in_file', type=str, help='a file containing the message')
-input_group.add_argument('-a', '--alpha', action='store_true', help='compute the full alphabet')
-parser.add_argument('-order', type=str, required=True, help='the rotor orders')
-parser.add_argument('-pos', type=str, required=True, help='the starting positions of the rotors')
-parser.add_argument('-plug', type=str, help='the plugboard in the format AB,CD...')
-parser.add_argument('-rotors', nargs='+', type=str)
+from crypto import (BASIC_TABLE, LETTER_CODES, OFFSET_LOWER, OFFSET_UPPER, BufferCipher, byte_view,
+	output_buffer, to_code)
 
-args = parser.parse_args()
+try:
+	import vector
+except ImportError:
+	vector = None
 
-print(args)
+# name: (wiring, turnover notches)
+ROTORS = {
+	'I': ('EKMFLGDQVZNTOWYHXUSPAIBRCJ', 'Q'),
+	'II': ('AJDKSIRUXBLHWTMCQGZNPYFVOE', 'E'),
+	'III': ('BDFHJLCPRTXVZNYEIWGAKMUSQO', 'V'),
+	'IV': ('ESOVPZJAYQUIRHXLNFTGKDCMWB', 'J'),
+	'V': ('VZBRGITYUPSDNHLXAWMQOFECKJ', 'Z'),
+	'VI': ('JPGVOUMFYQBENHZRDKASXLICTW', 'ZM'),
+	'VII': ('NZJHGRCXMYSWBOUFAIVLPEKQDT', 'ZM'),
+	'VIII': ('FKQHTLXOCBJSPGDIEUMNZWAVRY', 'ZM'),
+}
 
-order = [int(p) for p in args.order]
-positions = args.pos
+REFLECTORS = {
+	'A': 'EJMZALYXVBWFCRQUONTSPIKHGD',
+	'B': 'YRUHQSLDPXNGOKMIEBFZCWVJAT',
+	'C': 'FVPJIAOYEDRZXWGCTKUQSBNMHL',
+}
 
-plugboard = {}
-if args.plug:
-	for a, b in args.plug.split(','):
-		plugboard[a] = b
-		plugboard[b] = a
+# rotor positions (left, middle, right) packed as left * 676 + middle * 26 + right
+STATES = 26 ** 3
+# bytes.translate tables are 256 long; the codes of letters are all that are used
+_TABLE_TAIL = bytes(range(26, 256))
+_IDENTITY = bytes(range(26))
 
 
+def _shifted(wiring: Sequence[int], shift: int) -> bytes:
+	"""A translate table for wiring entered and left at an offset of shift."""
+	return bytes((wiring[(c + shift) % 26] - shift) % 26 for c in range(26)) + _TABLE_TAIL
+
+
+class Rotor:
+	__slots__ = 'forward', 'backward', 'notches'
+
+	def __init__(self, wiring: str, notches: str = ''):
+		if sorted(wiring.upper()) != list(ascii_uppercase):
+			raise ValueError(f"wiring must use every letter once: {wiring}")
+		self.forward = [to_code(a) for a in wiring]
+		self.backward = [0] * 26
+		for i, c in enumerate(self.forward):
+			self.backward[c] = i
+		self.notches = {to_code(n) for n in notches}
+
+	@classmethod
+	def from_name(cls, name: str):
+		return cls(*ROTORS[name.upper()])
+
+
+def _plugboard(pairs: str):
+	plugs = list(range(26))
+	for pair in pairs.replace(',', ' ').split():
+		if len(pair) != 2:
+			raise ValueError(f"plugboard pair must have two letters: {pair}")
+		a, b = (to_code(p) for p in pair)
+		if plugs[a] != a or plugs[b] != b or a == b:
+			raise ValueError(f"letter used twice in plugboard: {pair}")
+		plugs[a], plugs[b] = b, a
+	return plugs
+
+
+class Enigma(BufferCipher):
+	"""A three-rotor Enigma. The settings are fixed, and every message starts
+	from the same positions, so one instance can encrypt any number of messages.
+	Enciphering is its own inverse. Every state's substitution is worked out as it
+	is built, so that a shared instance is never written to."""
+	__slots__ = ('rotors', 'reflector', 'rings', 'plugboard', 'start', '_cycle', '_schedule')
+	seekable = True
+
+	def __init__(self, rotors: Sequence[Rotor | str], positions='AAA', rings='AAA',
+			reflector: str = 'B', plugboard: str = ''):
+		self.rotors = [r if isinstance(r, Rotor) else Rotor.from_name(r) for r in rotors]
+		if len(self.rotors) != 3 or len(positions) != 3 or len(rings) != 3:
+			raise ValueError('Enigma needs three rotors, positions and ring settings')
+		wiring = REFLECTORS.get(reflector.upper(), reflector)
+		self.reflector = Rotor(wiring).forward
+		if any(self.reflector[c] == c or self.reflector[self.reflector[c]] != c for c in range(26)):
+			raise ValueError(f"reflector must pair up every letter: {wiring}")
+		self.rings = [to_code(r) for r in rings]
+		self.plugboard = _plugboard(plugboard)
+		left, middle, right = (to_code(p) for p in positions)
+		self.start = left * 676 + middle * 26 + right
+		self._cycle = self._find_cycle()
+		self._schedule = self._build_schedule()
+
+	@classmethod
+	def cache_key(cls, rotors: Sequence[Rotor | str], positions='AAA', rings='AAA',
+			reflector: str = 'B', plugboard: str = ''):
+		rotors = tuple(r.upper() if isinstance(r, str) else (tuple(r.forward), frozenset(r.notches)) for r in rotors)
+		return (rotors, bytes(map(to_code, positions)), bytes(map(to_code, rings)),
+			REFLECTORS.get(reflector.upper(), reflector).upper(), tuple(_plugboard(plugboard)))
+
+	def step(self, state: int):
+		"""The rotor positions after one key press, including the middle rotor's double step."""
+		left, rem = divmod(state, 676)
+		middle, right = divmod(rem, 26)
+		notches_left, notches_middle, notches_right = (r.notches for r in self.rotors)
+		if middle in notches_middle:
+			middle = (middle + 1) % 26
+			left = (left + 1) % 26
+		elif right in notches_right:
+			middle = (middle + 1) % 26
+		right = (right + 1) % 26
+		return left * 676 + middle * 26 + right
+
+	def states(self, length: int, position: int = 0):
+		"""The state used for each of the next length key presses, after the first
+		position. The sequence always falls into a cycle within STATES steps, which
+		is then repeated."""
+		states, cycle_start = self._cycle
+		if position >= cycle_start:
+			position = cycle_start + (position - cycle_start) % (len(states) - cycle_start)
+		cycle = states[cycle_start:]
+		states = states[position:position + length]
+		while len(states) < length:
+			states += cycle
+		return list(states[:length])
+
+	def permutation(self, state: int):
+		"""The full substitution applied at one rotor state, plugboard included."""
+		return [self._encipher(state, c) for c in range(26)]
+
+	def _encipher(self, state: int, c: int):
+		shifts = [(p - r) % 26 for p, r in zip(divmod(state // 26, 26) + (state % 26,), self.rings)]
+		c = self.plugboard[c]
+		for rotor, shift in zip(reversed(self.rotors), reversed(shifts)):
+			c = (rotor.forward[(c + shift) % 26] - shift) % 26
+		c = self.reflector[c]
+		for rotor, shift in zip(self.rotors, shifts):
+			c = (rotor.backward[(c + shift) % 26] - shift) % 26
+		return self.plugboard[c]
+
+	def permutations(self, states):
+		"""The substitutions for many states at once, as a (len(states), 26) array. Needs NumPy."""
+		np = vector.np
+		states = np.asarray(states, dtype=np.intp)[:, np.newaxis]
+		positions = (states // 676, states // 26 % 26, states % 26)
+		shifts = [(p - r) % 26 for p, r in zip(positions, self.rings)]
+		forward = [np.array(r.forward) for r in self.rotors]
+		backward = [np.array(r.backward) for r in self.rotors]
+		plugboard = np.array(self.plugboard)
+		c = np.broadcast_to(plugboard, (len(states), 26))
+		for wiring, shift in zip(reversed(forward), reversed(shifts)):
+			c = (wiring[(c + shift) % 26] - shift) % 26
+		c = np.array(self.reflector)[c]
+		for wiring, shift in zip(backward, shifts):
+			c = (wiring[(c + shift) % 26] - shift) % 26
+		return plugboard[c]
+
+	def cycle(self):
+		"""Every state the machine passes through, in order until they repeat, and
+		the index where the repeating cycle starts."""
+		return self._cycle
+
+	def _find_cycle(self):
+		states = []
+		seen = {}
+		state = self.step(self.start)
+		while state not in seen:
+			seen[state] = len(states)
+			states.append(state)
+			state = self.step(state)
+		return tuple(states), seen[state]
+
+	def _build_schedule(self):
+		# The substitution of each state in the cycle, 26 bytes each, composed with
+		# bytes.translate. The left and middle rotors and the reflector only depend
+		# on the left and middle positions, so they are composed once for each.
+		left, middle, right = self.rotors
+		plugboard = bytes(self.plugboard) + _TABLE_TAIL
+		reflector = bytes(self.reflector) + _TABLE_TAIL
+		forward = [[_shifted(r.forward, s) for s in range(26)] for r in self.rotors]
+		backward = [[_shifted(r.backward, s) for s in range(26)] for r in self.rotors]
+		rings = self.rings
+		inner = {}
+		rows = []
+		for state in self._cycle[0]:
+			outer, r = divmod(state, 26)
+			sr = (r - rings[2]) % 26
+			core = inner.get(outer)
+			if core is None:
+				sl, sm = ((p - ring) % 26 for p, ring in zip(divmod(outer, 26), rings))
+				core = inner[outer] = (_IDENTITY.translate(forward[1][sm]).translate(forward[0][sl])
+					.translate(reflector).translate(backward[0][sl]).translate(backward[1][sm]) + _TABLE_TAIL)
+			rows.append(plugboard[:26].translate(forward[2][sr]).translate(core).translate(backward[2][sr])
+				.translate(plugboard))
+		return b''.join(rows)
+
+	def schedule(self):
+		"""The permutation of each state in cycle, as a read-only (len(states), 26)
+		uint8 array, and the index where the cycle starts. Needs NumPy."""
+		np = vector.np
+		return np.frombuffer(self._schedule, dtype=np.uint8).reshape(-1, 26), self._cycle[1]
+
+	def alphabet(self):
+		"""The substitution for the first key press, as the cipher letters for A to Z."""
+		return ''.join(chr(c + OFFSET_UPPER) for c in self.permutation(self.states(1)[0]))
+
+	def _cipher_into(self, data: Buffer, out: Buffer | None, offset: int, position: int):
+		data = byte_view(data)
+		out = output_buffer(out, len(data))
+		if vector and vector.accepts(data):
+			np = vector.np
+			table, cycle_start = self.schedule()
+			index = np.arange(position, position + len(data))
+			wrapped = index >= cycle_start
+			index[wrapped] = cycle_start + (index[wrapped] - cycle_start) % (len(table) - cycle_start)
+			vector.write(table[index, vector.letter_codes(data)], offset, out)
+		else:
+			table = self._schedule
+			cycle_start = self._cycle[1]
+			period = len(self._cycle[0]) - cycle_start
+			rows = (i if i < cycle_start else cycle_start + (i - cycle_start) % period
+				for i in range(position, position + len(data)))
+			codes = data.tobytes().translate(LETTER_CODES)
+			out[:] = bytes([table[row * 26 + c] + offset for row, c in zip(rows, codes)])
+		return out
+
+	def encrypt_into(self, data: Buffer, out: Buffer | None = None, position: int = 0):
+		return self._cipher_into(data, out, OFFSET_UPPER, position)
+
+	def decrypt_into(self, data: Buffer, out: Buffer | None = None, position: int = 0):
+		return self._cipher_into(data, out, OFFSET_LOWER, position)
+
+
+# Bombe: recovers settings from a crib, known plaintext at a known offset. Needs NumPy.
+#
+# Every hypothesis (rotor order, right ring setting, start position) fixes the
+# scrambler at each crib position, leaving only the plugboard. The crib's menu
+# links plaintext and ciphertext letters at each position, so guessing the
+# partner of the menu's most connected letter fixes the partners of every
+# letter reachable from it, and loops in the menu must come back consistent.
+# The left and middle ring settings are taken as A: they only change where the
+# slower rotors turn over, and otherwise act like a different start position.
+
+
+def _menu(plain: Sequence[int], cipher: Sequence[int]):
+	"""Chooses the test letter and orders the crib's links for propagation from it.
+	Returns the test letter, the letters it reaches, and the links as (known
+	letter, other letter, position, closes a loop) in an order where the known
+	letter is always reached first."""
+	links: dict[int, list[tuple[int, int]]] = {}
+	for i, (p, c) in enumerate(zip(plain, cipher)):
+		if p == c:
+			raise ValueError(f"crib letter {chr(p + OFFSET_UPPER)} enciphers to itself at position {i}")
+		links.setdefault(p, []).append((c, i))
+		links.setdefault(c, []).append((p, i))
+	test = max(links, key=lambda a: len(links[a]))
+	letters, order, used = [test], [], set()
+	for a in letters:
+		for b, i in links[a]:
+			if i in used:
+				continue
+			used.add(i)
+			order.append((a, b, i, b in letters))
+			if b not in letters:
+				letters.append(b)
+	return test, letters, order
+
+
+_shared = {}
+
+
+def _attach(names: dict[str, str], shapes: dict[str, tuple]):
+	from multiprocessing import shared_memory
+	np = vector.np
+	for key, name in names.items():
+		block = shared_memory.SharedMemory(name)
+		_shared[key] = block, np.ndarray(shapes[key], dtype=np.int16 if key == 'next' else np.uint8, buffer=block.buf)
+
+
+def _test_order(order: int, ring: int, plain, cipher, offset: int, top: int):
+	"""Tests every start position for one rotor order and right ring setting.
+	Returns (crib matches, order, ring, start state, plugboard) for the best stops."""
+	np = vector.np
+	perms = _shared['perms'][1][order].ravel()
+	next_state = _shared['next'][1][order].astype(np.intp)
+	test, letters, links = _menu(plain, cipher)
+	# the scrambler row used at each crib position, for each start position
+	state = np.arange(STATES)
+	for _ in range(offset):
+		state = next_state[state]
+	rows = []
+	for _ in plain:
+		state = next_state[state]
+		rows.append((state - state % 26 + (state % 26 - ring) % 26) * 26)
+
+	# one hypothesis per start position and partner of the test letter, dropped as soon as a loop fails
+	starts = np.repeat(np.arange(STATES), 26)
+	steckers = {test: np.tile(np.arange(26), STATES)}
+	for a, b, i, loop in links:
+		partner = perms[rows[i][starts] + steckers[a]]
+		if loop:
+			keep = partner == steckers[b]
+			starts = starts[keep]
+			steckers = {letter: values[keep] for letter, values in steckers.items()}
+		else:
+			steckers[b] = partner.astype(np.intp)
+
+	# diagonal board: partners are distinct, and a partner in the menu must pair back
+	menu = np.stack([steckers[a] for a in letters], axis=-1)
+	ordered = np.sort(menu, axis=-1)
+	ok = (ordered[:, 1:] != ordered[:, :-1]).all(axis=-1)
+	menu_index = np.full(26, -1)
+	menu_index[letters] = np.arange(len(letters))
+	back = menu_index[menu]
+	partner = np.take_along_axis(menu, np.maximum(back, 0), axis=-1)
+	ok &= ((back < 0) | (partner == np.array(letters))).all(axis=-1)
+	starts, menu = starts[ok], menu[ok]
+
+	index = np.arange(len(starts))[:, np.newaxis]
+	plugs = np.tile(np.arange(26), (len(starts), 1))
+	plugs[index, menu] = letters
+	plugs[index, letters] = menu
+	matches = np.zeros(len(starts), dtype=np.intp)
+	for i, (p, c) in enumerate(zip(plain, cipher)):
+		out = plugs[index[:, 0], perms[rows[i][starts] + plugs[:, p]]]
+		matches += out == c
+	best = np.argsort(-matches, kind='stable')[:top]
+	return [(int(matches[k]), order, ring, int(starts[k]), tuple(plugs[k].tolist())) for k in best]
+
+
+def bombe(ciphertext: str, crib: str, offset: int = 0, rotors: Sequence[str] = ('I', 'II', 'III', 'IV', 'V'),
+		reflector: str = 'B', rings: bool = False, workers: int | None = None, top: int = 20):
+	"""Searches every order of three of the given rotors and every start position
+	(and every right ring setting if rings is true) for settings that encipher the
+	crib to the ciphertext at the offset. Returns a stop list, best first, of
+	(crib matches, rotors, positions, rings, plugboard), where the plugboard holds
+	only the pairs implied by the crib. Pass all but the first to Enigma to try one."""
+	from concurrent.futures import ProcessPoolExecutor
+	from itertools import permutations
+	from multiprocessing import shared_memory
+	np = vector.np
+	plain = [to_code(a) for a in crib]
+	cipher = [to_code(a) for a in ciphertext[offset:offset + len(crib)]]
+	if len(cipher) < len(plain):
+		raise ValueError('crib runs past the end of the ciphertext')
+	_menu(plain, cipher)
+	orders = list(permutations(rotors, 3))
+	blocks = {}
+	try:
+		shapes = {'perms': (len(orders), STATES, 26), 'next': (len(orders), STATES)}
+		for key, shape in shapes.items():
+			dtype = np.int16 if key == 'next' else np.uint8
+			blocks[key] = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)) * np.dtype(dtype).itemsize)
+		perms = np.ndarray(shapes['perms'], dtype=np.uint8, buffer=blocks['perms'].buf)
+		next_state = np.ndarray(shapes['next'], dtype=np.int16, buffer=blocks['next'].buf)
+		for k, order in enumerate(orders):
+			machine = Enigma(order, reflector=reflector)
+			perms[k] = machine.permutations(np.arange(STATES))
+			next_state[k] = [machine.step(state) for state in range(STATES)]
+		names = {key: block.name for key, block in blocks.items()}
+		with ProcessPoolExecutor(workers, initializer=_attach, initargs=(names, shapes)) as pool:
+			futures = [pool.submit(_test_order, k, ring, plain, cipher, offset, top)
+				for k in range(len(orders)) for ring in (range(26) if rings else [0])]
+			stops = sorted((stop for f in futures for stop in f.result()), key=lambda stop: -stop[0])
+	finally:
+		for block in blocks.values():
+			block.close()
+			block.unlink()
+	results = []
+	for matches, k, ring, start, plugs in stops[:top]:
+		positions = ''.join(chr(c + OFFSET_UPPER) for c in (start // 676, start // 26 % 26, start % 26))
+		pairs = ' '.join(chr(a + OFFSET_UPPER) + chr(b + OFFSET_UPPER) for a, b in enumerate(plugs) if a < b)
+		results.append((matches, orders[k], positions, 'AA' + chr(ring + OFFSET_UPPER), pairs))
+	return results
+
+
+if __name__ == '__main__':
+	import argparse
+	import sys
+
+	import cryptoshell
+
+	parser = argparse.ArgumentParser(
+		prog='enigma',
+		description=f"Encrypts a message using the Enigma Machine. {cryptoshell.MODE_HELP}")
+	input_group = parser.add_mutually_exclusive_group()
+	input_group.add_argument('message', nargs='?', type=str, help='the text of the message. May be passed with stdin instead.')
+	input_group.add_argument('-in', metavar='FILE', dest='in_file', type=str, help='a file containing the message')
+	input_group.add_argument('-a', '--alpha', action='store_true', help='compute the full alphabet')
+	parser.add_argument('-order', type=str, help='the rotor order from left to right, such as 123 for I, II, III')
+	parser.add_argument('-pos', type=str, help='the starting positions of the rotors, such as AAA')
+	parser.add_argument('-ring', type=str, default='AAA', help='the ring settings of the rotors (default: AAA)')
+	parser.add_argument('-reflector', type=str, default='B', help='the reflector, A, B or C, or its full wiring (default: B)')
+	parser.add_argument('-plug', type=str, default='', help='the plugboard in the format AB,CD...')
+	parser.add_argument('-rotors', nargs='+', type=str, metavar='WIRING',
+		help='custom rotor wirings to use instead of the standard rotors I-VIII, numbered from 1 for -order. A wiring may end with /NOTCHES.')
+	parser.add_argument('-crib', type=str,
+		help='Search for the settings from known plaintext in the message instead, like a bombe, and print a stop list. -order then lists the rotors to choose from (default: 12345).')
+	parser.add_argument('-offset', type=int, default=0, help='where the crib starts in the message (default: 0)')
+	parser.add_argument('-search-rings', action='store_true',
+		help='also try every ring setting of the right rotor, which matters if the middle rotor turns over within the crib')
+	parser.add_argument('-workers', type=int, help='the number of processes to search with. Defaults to one per CPU.')
+	cryptoshell.mode_args(parser)
+	cryptoshell.batch_args(parser)
+	cryptoshell.stream_args(parser)
+	cryptoshell.stats_args(parser)
+	cryptoshell.daemon_args(parser)
+	args = parser.parse_args()
+	stats = cryptoshell.Stats.from_args(args)
+
+	if args.rotors:
+		available = [Rotor(*w.split('/')) for w in args.rotors]
+	else:
+		available = list(ROTORS)
+
+	# read as it is used, which in stream mode is a chunk at a time
+	message = open(args.in_file, 'rb') if args.in_file else None
+
+	if args.crib:
+		if vector is None:
+			parser.error('-crib requires NumPy')
+		message = cryptoshell.read_message(args) if message is None else message.read()
+		message = str(BASIC_TABLE.translate_bytes(message), 'ascii')
+		rotors = [available[int(p) - 1] for p in args.order or '12345']
+		stops = bombe(message, BASIC_TABLE.translate(args.crib), args.offset,
+			rotors, args.reflector, args.search_rings, args.workers)
+		names = {rotor: str(i) for i, rotor in enumerate(available, start=1)}
+		print('\n'.join(
+			f"{matches}/{len(args.crib)} -order {''.join(names[r] for r in order)} -pos {pos} -ring {rings} -plug {plug.replace(' ', ',')}"
+			for matches, order, pos, rings, plug in stops), end='')
+		sys.exit()
+	if not args.order or not args.pos:
+		parser.error('the following arguments are required: -order, -pos')
+	if not args.rotors and not args.in_file and not args.alpha:
+		key = {'rotors': [available[int(p) - 1] for p in args.order], 'positions': args.pos, 'rings': args.ring,
+			'reflector': args.reflector, 'plugboard': args.plug}
+		if cryptoshell.forward(args, 'enigma', key):
+			sys.exit()
+	with stats.phase('setup'):
+		enigma = Enigma([available[int(p) - 1] for p in args.order], args.pos, args.ring, args.reflector, args.plug)
+
+	if args.alpha:
+		print(enigma.alphabet(), end='')
+	else:
+		cryptoshell.run_cipher(args, enigma.encrypt_into, enigma.decrypt_into, message=message, stats=stats,
+			cipher=enigma)
@@ -0,0 +1,136 @@
+import numpy as np
+
+import vector
+from crypto import BASIC_TABLE, FileType
+
+# the n-gram lengths an index holds, with a table of 26 ** n log probabilities for each
+SIZES = (1, 2, 3, 4)
+# an index file is MAGIC, then each table in order as little-endian float32
+MAGIC = b'NGRAMS1\n'
+DTYPE = np.dtype('<f4')
+# log10 probability given to an n-gram never seen in the corpus, relative to one seen once
+FLOOR = 0.01
+
+
+def ngram_ids(codes: np.ndarray, n: int = 4) -> np.ndarray:
+	"""The index of each n-gram of letter codes, along the last axis."""
+	codes = np.asarray(codes).astype(np.intp)
+	count = codes.shape[-1] - n + 1
+	if count <= 0:
+		return np.empty(codes.shape[:-1] + (0,), dtype=np.intp)
+	ids = codes[..., :count].copy()
+	for i in range(1, n):
+		ids *= 26
+		ids += codes[..., i:i + count]
+	return ids
+
+
+class NGrams:
+	"""Log10 probabilities of every n-gram of letters, for each n in SIZES.
+	Loaded from an index file, the tables are memory-mapped, so loading is
+	instant and processes that load the same file share its pages."""
+	__slots__ = ('tables', 'path')
+
+	def __init__(self, tables, path: FileType | None = None):
+		self.tables = tuple(tables)
+		self.path = path
+
+	def __reduce__(self):
+		# worker processes map the file again rather than receive a copy
+		if self.path is not None:
+			return type(self).load, (self.path,)
+		return type(self), (self.tables,)
+
+	@classmethod
+	def from_corpus(cls, text: str):
+		codes = vector.letter_codes(BASIC_TABLE.translate(text))
+		tables = []
+		for n in SIZES:
+			counts = np.bincount(ngram_ids(codes, n), minlength=26 ** n).astype(np.float64)
+			total = counts.sum()
+			if not total:
+				raise ValueError(f"corpus has fewer than {n} letters")
+			counts[counts == 0] = FLOOR
+			tables.append(np.log10(counts / total).astype(DTYPE))
+		return cls(tables)
+
+	@classmethod
+	def from_corpus_file(cls, path: FileType):
+		# as bytes, since only the ASCII letters are kept, whatever the encoding
+		with open(path, 'rb') as f:
+			return cls.from_corpus(BASIC_TABLE.translate_bytes(f.read()).decode('ascii'))
+
+	@classmethod
+	def load(cls, path: FileType):
+		"""Maps an index file written by save."""
+		with open(path, 'rb') as f:
+			if f.read(len(MAGIC)) != MAGIC:
+				raise ValueError(f"not an n-gram index: {path}")
+		data = np.memmap(path, dtype=DTYPE, mode='r', offset=len(MAGIC))
+		if len(data) != sum(26 ** n for n in SIZES):
+			raise ValueError(f"n-gram index has the wrong size: {path}")
+		tables = []
+		start = 0
+		for n in SIZES:
+			tables.append(np.asarray(data[start:start + 26 ** n]))
+			start += 26 ** n
+		return cls(tables, path)
+
+	@classmethod
+	def from_file(cls, path: FileType):
+		"""Loads an index file, or counts a corpus of text if that is what the file is."""
+		with open(path, 'rb') as f:
+			is_index = f.read(len(MAGIC)) == MAGIC
+		return cls.load(path) if is_index else cls.from_corpus_file(path)
+
+	def save(self, path: FileType):
+		with open(path, 'wb') as f:
+			f.write(MAGIC)
+			for table in self.tables:
+				f.write(np.asarray(table, dtype=DTYPE).tobytes())
+
+	def table(self, n: int = 4) -> np.ndarray:
+		return self.tables[SIZES.index(n)]
+
+	def score(self, codes: np.ndarray, n: int = 4) -> float:
+		"""Total log10 probability of a text given as letter codes."""
+		return float(self.table(n)[ngram_ids(codes, n)].sum(dtype=np.float64))
+
+	def score_batch(self, texts, n: int = 4) -> np.ndarray:
+		"""The score of each of many texts at once: the rows of a 2D array of
+		letter codes, or a sequence of code arrays of any lengths."""
+		table = self.table(n)
+		if isinstance(texts, np.ndarray) and texts.ndim == 2:
+			return table[ngram_ids(texts, n)].sum(axis=1, dtype=np.float64)
+		lengths = np.array([len(t) for t in texts], dtype=np.intp)
+		if not len(lengths):
+			return np.zeros(0)
+		# sums over each text's own n-grams, skipping those that span two texts
+		sums = np.concatenate(([0], np.cumsum(table[ngram_ids(np.concatenate(texts), n)], dtype=np.float64)))
+		starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+		ends = np.maximum(starts, starts + lengths - n + 1)
+		# a text too short for any n-gram may start past the last one
+		last = len(sums) - 1
+		return sums[np.minimum(ends, last)] - sums[np.minimum(starts, last)]
+
+	def rescore(self, codes: np.ndarray, score: float, pos: int, code: int, n: int = 4) -> float:
+		"""The score of codes with codes[pos] changed to code, given its score
+		before, from only the n-grams that cover pos. codes itself is unchanged."""
+		lo = max(pos - n + 1, 0)
+		window = np.asarray(codes[lo:pos + n]).astype(np.intp)
+		table = self.table(n)
+		before = table[ngram_ids(window, n)].sum(dtype=np.float64)
+		window[pos - lo] = code
+		return score - before + table[ngram_ids(window, n)].sum(dtype=np.float64)
+
+
+if __name__ == '__main__':
+	import argparse
+
+	parser = argparse.ArgumentParser(
+		description='Builds an n-gram index from a corpus of English text, for the tools that score candidate decryptions. The index is a few megabytes and loads instantly.')
+	parser.add_argument('corpus', help='a file of English text')
+	parser.add_argument('index', help='the index file to write')
+	args = parser.parse_args()
+
+	NGrams.from_corpus_file(args.corpus).save(args.index)
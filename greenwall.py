@@ -1,66 +1,58 @@
-from itertools import product
-from string import ascii_lowercase, ascii_uppercase
+from collections.abc import Buffer
+from string import ascii_uppercase
 
-from crypto import collect_to_str, OFFSET_UPPER, AsciiTranslationTable
+import modular
+from crypto import BufferCipher, get_alphabet
 
 MULT_INV = [None] + [pow(i, -1, 29) for i in range(1, 29)]
 PUNCT = ' ,.'
-ALPHA_UPPER = ascii_uppercase + PUNCT
-ALPHA_LOWER = ascii_lowercase + PUNCT
+ALPHABET = get_alphabet(ascii_uppercase + PUNCT)
+TEXT_FILTER = ALPHABET.text_filter
 
 
-def _to_code(a):
-	c = ord(a)
-	if c >= OFFSET_UPPER:
-		return (c - OFFSET_UPPER) & 0x1F
-	# not super elegant but it's fast
-	if c == 32:  # ' '
-		return 26
-	if c == 44:  # ','
-		return 27
-	if c == 46:  # '.'
-		return 28
-	raise ValueError(a)
+class Greenwall(BufferCipher):
+	seekable = True
 
-
-def _encrypt(c: int, horiz_value: int, vert_value: int, block_value: int):
-	return ((block_value * c + horiz_value) * vert_value) % 29
-
-def _decrypt(c: int, horiz_value: int, vert_value: int, block_value: int):
-	return ((MULT_INV[vert_value] * c - horiz_value) * MULT_INV[block_value]) % 29
-
-
-class Greenwall:
-	
 	def __init__(self, horizontal, vertical):
-		self.horiz_values = [_to_code(h) for h in horizontal]
-		self.vert_values = [_to_code(v) + 1 for v in vertical]
-		
-	def _iter_values(self):
-		block_num = 0
-		while True:
-			b = (block_num % 28) + 1
+		self.horiz_values = list(ALPHABET.codes(horizontal))
+		self.vert_values = [v + 1 for v in ALPHABET.codes(vertical)]
+		if 29 in self.vert_values:
+			raise ValueError("vertical keyword cannot contain '.', which has no inverse")
+		# One period of the key schedule as affine coefficients mod 29: encrypting
+		# is ((b * c + h) * v) % 29 == (mult * c + add) % 29, and likewise decrypting.
+		encrypt_mult, encrypt_add, decrypt_mult, decrypt_add = (bytearray() for _ in range(4))
+		for h, v, b in self._iter_period():
+			encrypt_mult.append(b * v % 29)
+			encrypt_add.append(h * v % 29)
+			decrypt_mult.append(MULT_INV[b * v % 29])
+			decrypt_add.append(-h * MULT_INV[b] % 29)
+		self.encrypt_coeffs = bytes(encrypt_mult), bytes(encrypt_add)
+		self.decrypt_coeffs = bytes(decrypt_mult), bytes(decrypt_add)
+
+	@classmethod
+	def cache_key(cls, horizontal, vertical):
+		return ALPHABET.codes(horizontal), ALPHABET.codes(vertical)
+
+	def _iter_period(self):
+		for block_num in range(28):
+			b = block_num + 1
 			for v in self.vert_values:
 				for h in self.horiz_values:
 					yield h, v, b
-			block_num += 1
-	
-	@collect_to_str
-	def _cipher(self, message, mode, alphabet):
-		for a, (h, v, b) in zip(message, self._iter_values()):
-			yield alphabet[mode(_to_code(a), h, v, b)]
 
+	def encrypt_into(self, data: Buffer, out: Buffer | None = None, position: int = 0):
+		mult, add = self.encrypt_coeffs
+		return modular.affine_into(data, ALPHABET, add, ALPHABET.upper, mult, out, position)
 
-	def encrypt(self, message):
-		return self._cipher(message, _encrypt, ALPHA_UPPER)
-
-	def decrypt(self, message):
-		return self._cipher(message, _decrypt, ALPHA_LOWER)
+	def decrypt_into(self, data: Buffer, out: Buffer | None = None, position: int = 0):
+		mult, add = self.decrypt_coeffs
+		return modular.affine_into(data, ALPHABET, add, ALPHABET.lower, mult, out, position)
 
 
 if __name__ == '__main__':
 	import argparse
 	import functools
+	import sys
 
 	import cryptoshell
 
@@ -73,9 +65,16 @@ if __name__ == '__main__':
 	parser.add_argument('-v', '--vertical', type=str, required=True, metavar='VERT', 
 		help='the vertical (multiplicative) keyword')
 	cryptoshell.mode_args(parser)	
+	cryptoshell.batch_args(parser)
+	cryptoshell.stream_args(parser)
+	cryptoshell.stats_args(parser)
+	cryptoshell.daemon_args(parser)
 	args = parser.parse_args()
+	stats = cryptoshell.Stats.from_args(args)
 	
-	table = AsciiTranslationTable.with_letters(PUNCT)
-
-	greenwall = Greenwall(args.horizontal, args.vertical)
-	cryptoshell.run_cipher(args, greenwall.encrypt, greenwall.decrypt, table)
+	if cryptoshell.forward(args, 'greenwall', [args.horizontal, args.vertical]):
+		sys.exit()
+	with stats.phase('setup'):
+		greenwall = Greenwall(args.horizontal, args.vertical)
+	cryptoshell.run_cipher(args, greenwall.encrypt_into, greenwall.decrypt_into, TEXT_FILTER, stats=stats,
+		cipher=greenwall)
@@ -1,24 +1,41 @@
 import sys
 import secrets
-import string
 from string import ascii_uppercase as ALPHA
 
-def exclude(letter):
-	i = ALPHA.index(letter)
-	return ALPHA[:i] + ALPHA[i + 1:]
+from crypto import ALPHABETS
+
+CHUNK_SIZE = 1 << 16
 
-ALPHABETS = {
-	'25': exclude('J'),
-	'26': ALPHA,
-	'29': ALPHA + ' ,.',
-	'36': ALPHA + string.digits,
-}
 
 def generate(alphabet, length):
 	for _ in range(length):
 		yield secrets.choice(alphabet)
 
 
+def generate_chunks(alphabet: str, length: int, chunk_size: int = CHUNK_SIZE):
+	"""Yields the key as ASCII bytes in chunks of up to chunk_size. Random bytes are
+	drawn in blocks and mapped onto the alphabet with bytes.translate, deleting
+	the top 256 % len(alphabet) byte values so every letter is equally likely."""
+	codes = alphabet.encode('ascii')
+	if not 0 < len(codes) <= 256:
+		raise ValueError(f"alphabet must have 1 to 256 characters, not {len(codes)}")
+	limit = 256 - 256 % len(codes)
+	table = bytes(codes[b % len(codes)] for b in range(256))
+	rejected = bytes(range(limit, 256))
+	while length > 0:
+		want = min(length, chunk_size)
+		# draw a little extra so one draw is nearly always enough
+		chunk = secrets.token_bytes(want * 256 // limit + 64).translate(table, rejected)[:want]
+		length -= len(chunk)
+		yield chunk
+
+
+def write_key(out, alphabet: str, length: int, chunk_size: int = CHUNK_SIZE):
+	"""Streams a key to a binary file in constant memory."""
+	for chunk in generate_chunks(alphabet, length, chunk_size):
+		out.write(chunk)
+
+
 if __name__ == '__main__':
 	import argparse
 
@@ -26,6 +43,7 @@ if __name__ == '__main__':
 		description='Generates random keys for classical ciphers.')
 	parser.add_argument('-a', '--alpha', metavar='ALPHABET', type=str, default=ALPHA, help='the alphabet of the key')
 	parser.add_argument('-l', '--length', type=int, help='the length of the key')
+	parser.add_argument('-o', '--output', metavar='FILE', type=str, help='a file to write the key to instead of stdout (ideal for one-time pads)')
 	args = parser.parse_args()
 
 	length = args.length
@@ -36,6 +54,8 @@ if __name__ == '__main__':
 	else:
 		alphabet = args.alpha
 
-	result = ''.join(generate(alphabet, length))
-	
-	print(result, end='')
+	if args.output:
+		with open(args.output, 'wb') as f:
+			write_key(f, alphabet, length)
+	else:
+		write_key(sys.stdout.buffer, alphabet, length)
@@ -0,0 +1,149 @@
+from collections.abc import Buffer
+from itertools import cycle
+
+from crypto import Alphabet, byte_view, output_buffer
+
+try:
+	import vector
+except ImportError:
+	vector = None
+
+# periods no longer than this fraction of the message are applied one column at a time with bytes.translate
+LANE_RATIO = 8
+
+
+def _bytes(data: Buffer) -> bytes:
+	return data if isinstance(data, bytes) else byte_view(data).tobytes()
+
+
+def _rotate(key: bytes | None, position: int):
+	if key is None or not (shift := position % len(key)):
+		return key
+	return key[shift:] + key[:shift]
+
+
+def affine_into(data: Buffer, alphabet: Alphabet, add: Buffer, decode: bytes, mult: Buffer | None = None,
+		out: Buffer | None = None, position: int = 0):
+	"""Writes decode[(mult[i] * c + add[i]) % N] for the character with code c at
+	position i of the message, with mult and add (codes, of the same length)
+	repeating. That is a shift for one add, the affine cipher for one mult and
+	add, Vigenère for add the key, and so on. mult None is all ones. decode is
+	alphabet.upper or alphabet.lower. position is where data starts in the
+	message, for a message in chunks."""
+	data = byte_view(data)
+	codes = alphabet.codes(data)
+	out = output_buffer(out, len(codes))
+	add = _bytes(add)
+	if mult is not None:
+		mult = _bytes(mult)
+		if len(mult) != len(add):
+			raise ValueError('multipliers and shifts must have the same length')
+	if not add:
+		if codes:
+			raise ValueError('key is empty')
+		return out
+	n = len(alphabet)
+	add, mult = _rotate(add, position), _rotate(mult, position)
+	if vector and vector.accepts(codes):
+		np = vector.np
+		add = vector.tile(np.frombuffer(add[:len(codes)], dtype=np.uint8), len(codes))
+		if mult is None and 2 * n <= 256:
+			# the sums stay below 2N, so they fit in bytes and mod_table does the rest
+			codes = np.frombuffer(codes, dtype=np.uint8) + add
+		else:
+			codes = np.frombuffer(codes, dtype=np.uint8).astype(np.uint16)
+			if mult is not None:
+				codes *= vector.tile(np.frombuffer(mult[:len(codes)], dtype=np.uint8), len(codes))
+			codes += add
+			codes %= n
+			codes = codes.astype(np.uint8)
+		out[:] = codes.tobytes().translate(alphabet.mod_table(decode))
+	elif len(add) * LANE_RATIO <= len(codes):
+		width = len(add)
+		for j, (m, a) in enumerate(zip(mult or b'\1' * width, add)):
+			out[j::width] = data[j::width].tobytes().translate(alphabet.table(m, a, decode))
+	elif mult is None:
+		out[:] = bytes([(c + a) % n for c, a in zip(codes, cycle(add))]).translate(decode)
+	else:
+		out[:] = bytes([(m * c + a) % n for c, m, a in zip(codes, cycle(mult), cycle(add))]).translate(decode)
+	return out
+
+
+def vigenere_into(data: Buffer, alphabet: Alphabet, key: Buffer, sign: int, out: Buffer | None = None,
+		position: int = 0):
+	"""key is a buffer of codes. Encrypting (sign +1) writes upper case, and decrypting (-1) lower case."""
+	key = _bytes(key)
+	if sign < 0:
+		return affine_into(data, alphabet, key.translate(alphabet.negation()), alphabet.lower, out=out, position=position)
+	return affine_into(data, alphabet, key, alphabet.upper, out=out, position=position)
+
+
+def autokey_into(data: Buffer, alphabet: Alphabet, key: Buffer, sign: int, out: Buffer | None = None):
+	"""Like vigenere_into, but the key is followed by the plaintext, instead of repeating."""
+	key = _bytes(key)
+	if not key:
+		raise ValueError('key is empty')
+	codes = alphabet.codes(data)
+	out = output_buffer(out, len(codes))
+	if vector and vector.accepts(codes):
+		(_encrypt_array if sign > 0 else _decrypt_array)(codes, len(alphabet), key, alphabet, out)
+	elif sign > 0:
+		_encrypt_bytes(codes, len(alphabet), key, alphabet, out)
+	else:
+		_decrypt_bytes(codes, len(alphabet), key, alphabet, out)
+	return out
+
+
+def _encrypt_bytes(codes: bytes, n: int, key: bytes, alphabet: Alphabet, out: Buffer):
+	key = key[:len(codes)]
+	stream = key + codes[:len(codes) - len(key)]
+	out[:] = bytes([(c + k) % n for c, k in zip(codes, stream)]).translate(alphabet.upper)
+
+
+def _decrypt_bytes(codes: bytes, n: int, key: bytes, alphabet: Alphabet, out: Buffer):
+	# plain[t] is the key for position t + n, for a key of length n
+	plain = list(key)
+	for c in codes:
+		plain.append((c - plain[-len(key)]) % n)
+	out[:] = bytes(plain[len(key):]).translate(alphabet.lower)
+
+
+def _encrypt_array(codes: bytes, n: int, key: bytes, alphabet: Alphabet, out: Buffer):
+	np = vector.np
+	codes = np.frombuffer(codes, dtype=np.uint8)
+	key_codes = np.frombuffer(key[:len(codes)], dtype=np.uint8)
+	stream = np.concatenate((key_codes, codes[:len(codes) - len(key_codes)]))
+	if 2 * n <= 256:
+		codes = codes + stream
+	else:
+		codes = ((codes.astype(np.uint16) + stream) % n).astype(np.uint8)
+	out[:] = codes.tobytes().translate(alphabet.mod_table(alphabet.upper))
+
+
+def _decrypt_array(codes: bytes, n: int, key: bytes, alphabet: Alphabet, out: Buffer, block_rows: int = 1 << 16):
+	# Lane j holds positions j, j + k, j + 2k, ... for a key of length k, and
+	# p[t] = c[t] - p[t - 1] within a lane. With q[t] = (-1)^t p[t], that is
+	# q[t] = q[t - 1] + (-1)^t c[t], a prefix sum starting from -key[j].
+	np = vector.np
+	msg_len = len(codes)
+	key_codes = np.frombuffer(key[:msg_len], dtype=np.uint8).astype(np.int32)
+	lanes = len(key_codes)
+	rows = -(-msg_len // lanes)
+	grid = np.zeros(rows * lanes, dtype=np.uint8)
+	grid[:msg_len] = np.frombuffer(codes, dtype=np.uint8)
+	grid = grid.reshape(rows, lanes)
+	# an even block size keeps every block starting on a positive row
+	signs = np.where(np.arange(block_rows) % 2 == 0, 1, -1).astype(np.int32)[:, np.newaxis]
+	carry = -key_codes
+	for start in range(0, rows, block_rows):
+		view = grid[start:start + block_rows]
+		block_signs = signs[:len(view)]
+		block = view * block_signs
+		np.cumsum(block, axis=0, out=block)
+		block += carry
+		block %= n
+		carry = block[-1].copy()
+		block *= block_signs
+		block %= n
+		view[:] = block
+	out[:] = grid.ravel()[:msg_len].tobytes().translate(alphabet.lower)
@@ -1,11 +1,25 @@
-from collections.abc import Iterable, Sequence
-from itertools import chain
+import math
+import os
+import random
+import re
+import time
+from collections.abc import Buffer, Callable, Iterable, Sequence
+from itertools import chain, count
 from string import ascii_uppercase
 
-from crypto import add_unique, to_code, batched, collect_to_str
+from crypto import (BASIC_TABLE, LETTER_CODES, OFFSET_UPPER, BufferCipher, CipherStream, add_unique, batched,
+	byte_view, cached, output_buffer, to_code)
+
+try:
+	import vector
+except ImportError:
+	vector = None
 
 Grid = Sequence[Sequence[str]]
 
+# a run of pairs of different letters, then the letter (if any) that needs a separator
+_UNPAIRED = re.compile(rb'((?:(.)(?!\2).)*+)(.)?', re.IGNORECASE | re.DOTALL)
+
 
 def make_key(keyword: str, combine='IJ'):
 	share, replace = combine
@@ -30,51 +44,73 @@ def _create_lookup(grid: Grid, combine='IJ'):
 	return lookup
 
 
-def _ensure_ciphertext(message: str):
-	for a1, a2 in batched(message, 2):
-		c1 = to_code(a1)
-		c2 = to_code(a2)
+def _ensure_ciphertext(codes: bytes):
+	if len(codes) % 2:
+		raise ValueError('ciphertext has odd length')
+	for c1, c2 in zip(codes[0::2], codes[1::2]):
 		if c1 == c2:
 			raise ValueError(f"ciphertext has double {c1}")
 		yield c1, c2
 
 
-class Playfair:
+def _ensure_ciphertext_array(message: str | Buffer):
+	if len(message) % 2:
+		raise ValueError('ciphertext has odd length')
+	pairs = vector.letter_codes(message).reshape(-1, 2)
+	doubles = (pairs[:, 0] == pairs[:, 1]).nonzero()[0]
+	if len(doubles):
+		raise ValueError(f"ciphertext has double {pairs[doubles[0], 0]}")
+	return pairs
+
+
+def _code_pairs(codes: bytes):
+	return zip(codes[0::2], codes[1::2])
+
+
+def _pair_bytes(table: list[bytes | None]):
+	return b''.join(pair or b'\0\0' for pair in table)
+
+
+class Playfair(BufferCipher):
+	__slots__ = ('grid', 'separator', 'alt_separator', 'lookup', 'encrypt_table', 'decrypt_table',
+		'encrypt_pairs', 'decrypt_pairs')
 
 	def __init__(self, grid: Grid, separator='X', alt_separator='Q', combine='IJ'):
 		self.grid = grid
 		self.separator = to_code(separator)
 		self.alt_separator = to_code(alt_separator)
 		self.lookup = _create_lookup(grid, combine)
+		# every digraph, indexed by c1 * 26 + c2
+		self.encrypt_table = self._create_table(1, str.upper)
+		self.decrypt_table = self._create_table(-1, str.lower)
+		# the same as bytes, which NumPy views without copying (see vector.pair_table)
+		self.encrypt_pairs = _pair_bytes(self.encrypt_table)
+		self.decrypt_pairs = _pair_bytes(self.decrypt_table)
 
 	@classmethod
 	def from_keyword(cls, keyword, separator='X', alt_separator='Q', combine='IJ'):
 		grid = list(batched(make_key(keyword, combine), 5))
 		return cls(grid, separator, alt_separator, combine)
+
+	create = from_keyword
+
+	@classmethod
+	def cache_key(cls, keyword, separator='X', alt_separator='Q', combine='IJ'):
+		# keywords that give the same grid share an entry
+		return ''.join(make_key(keyword, combine)), to_code(separator), to_code(alt_separator), combine
 	
 	def _separator_for(self, c: int):
 		return self.separator if c != self.separator else self.alt_separator
 
-	def _separate_doubles(self, message: str):
-		i = 0
-		msg_len = len(message)
-		while True:
-			rem = msg_len - i
-			if rem == 0:
-				return
-
-			c1 = to_code(message[i])
-			if rem == 1:
-				yield c1, self._separator_for(c1)
-				return	
-
-			c2 = to_code(message[i + 1])
-			if c1 == c2:
-				c2 = self._separator_for(c1)
-				i += 1
-			else:
-				i += 2
-			yield c1, c2
+	def _separate_pair(self, match: re.Match):
+		run, single = match.group(1, 3)
+		if single is None:
+			return run
+		return run + single + bytes([self._separator_for(LETTER_CODES[single[0]]) + OFFSET_UPPER])
+
+	def _separate_doubles(self, message: Buffer) -> bytes:
+		"""Returns the message with separators inserted so it splits into pairs of different letters."""
+		return _UNPAIRED.sub(self._separate_pair, message)
 
 	def encode_pair(self, c1: int, c2: int, shift: int = 1):
 		row1, col1 = self.lookup[c1]
@@ -91,18 +127,254 @@ class Playfair:
 			self.grid[row1][col2],
 			self.grid[row2][col1])
 
-	@collect_to_str
-	def _process(self, message: Iterable[tuple[str, str]], shift: int):
-		for c1, c2 in message:
-			yield from self.encode_pair(c1, c2, shift)
+	def _create_table(self, shift: int, case: Callable[[str], str]):
+		table: list[bytes | None] = [None] * (26 * 26)
+		for c1 in range(26):
+			for c2 in range(26):
+				if self.lookup[c1] is not None and self.lookup[c2] is not None:
+					table[c1 * 26 + c2] = case(''.join(self.encode_pair(c1, c2, shift))).encode('ascii')
+		return table
+
+	@staticmethod
+	def _process(message: Iterable[tuple[int, int]], table: list[bytes | None], out: Buffer):
+		out[:] = b''.join([table[c1 * 26 + c2] for c1, c2 in message])
+
+	def encrypt_into(self, data: Buffer, out: Buffer | None = None):
+		"""Separators may make the output longer than data, so it cannot always be done in place."""
+		return self._encrypt_pairs(self._separate_doubles(byte_view(data)), out)
+
+	def _encrypt_pairs(self, message: bytes, out: Buffer | None = None):
+		out = output_buffer(out, len(message))
+		if vector and vector.accepts(message):
+			pairs = vector.letter_codes(message).reshape(-1, 2)
+			vector.gather_pairs(pairs, vector.pair_table(self.encrypt_pairs), out)
+		else:
+			self._process(_code_pairs(message.translate(LETTER_CODES)), self.encrypt_table, out)
+		return out
+
+	def decrypt_into(self, data: Buffer, out: Buffer | None = None):
+		data = byte_view(data)
+		out = output_buffer(out, len(data))
+		if vector and vector.accepts(data):
+			vector.gather_pairs(_ensure_ciphertext_array(data), vector.pair_table(self.decrypt_pairs), out)
+		else:
+			self._process(_ensure_ciphertext(data.tobytes().translate(LETTER_CODES)), self.decrypt_table, out)
+		return out
+
+	def encryptor(self):
+		return _EncryptStream(self)
+
+	def decryptor(self):
+		return _DecryptStream(self)
+
+
+class _EncryptStream(CipherStream):
+	"""Pairs are found from the start of the message, so only a letter at the end
+	of a chunk that has no pair yet depends on the next chunk. It is held back."""
+	__slots__ = ('cipher', 'held')
+
+	def __init__(self, cipher: Playfair):
+		self.cipher = cipher
+		self.held = b''
+
+	def update(self, data: Buffer):
+		data = self.held + byte_view(data).tobytes()
+		self.held = b''
+
+		def separate(match: re.Match):
+			if match.end(3) == len(data):
+				self.held = match[3]
+				return match[1]
+			return self.cipher._separate_pair(match)
 
+		return self.cipher._encrypt_pairs(_UNPAIRED.sub(separate, data))
 
-	def encrypt(self, message: str):
-		return self._process(self._separate_doubles(message), 1).upper()
+	def finish(self):
+		return self.cipher.encrypt_into(self.held)
 
 
-	def decrypt(self, message: str):
-		return self._process(_ensure_ciphertext(message), -1).lower()
+class _DecryptStream(CipherStream):
+	__slots__ = ('cipher', 'held')
+
+	def __init__(self, cipher: Playfair):
+		self.cipher = cipher
+		self.held = b''
+
+	def update(self, data: Buffer):
+		data = self.held + byte_view(data).tobytes()
+		cut = len(data) - len(data) % 2
+		self.held = data[cut:]
+		return self.cipher.decrypt_into(memoryview(data)[:cut])
+
+	def finish(self):
+		# an odd letter left over is an error, as for the whole message
+		return self.cipher.decrypt_into(self.held)
+
+
+# Solver: simulated annealing over 5x5 grids (IJ combined), scored by quadgram fitness.
+# Needs NumPy. Grids are arrays of 25 letter codes; a grid position is row * 5 + column.
+
+def _position_table(shift: int):
+	"""Maps a pair of grid positions p1 * 25 + p2 to the pair of positions it
+	enciphers to. This is the same for every grid, so the solver only has to
+	relabel it with each candidate's letters."""
+	table = []
+	for p1 in range(25):
+		for p2 in range(25):
+			(row1, col1), (row2, col2) = divmod(p1, 5), divmod(p2, 5)
+			if row1 == row2:
+				col1, col2 = (col1 + shift) % 5, (col2 + shift) % 5
+			elif col1 == col2:
+				row1, row2 = (row1 + shift) % 5, (row2 + shift) % 5
+			else:
+				col1, col2 = col2, col1
+			table.append((row1 * 5 + col1, row2 * 5 + col2))
+	return table
+
+
+class _Annealer:
+	"""Scores candidate grids against one ciphertext, reusing its buffers for every
+	candidate, so that nothing the size of the text is allocated per candidate."""
+
+	def __init__(self, codes, log_probs, rng):
+		np = vector.np
+		ids = codes[0::2].astype(np.intp) * 26 + codes[1::2]
+		digraphs, self.digraph_index = np.unique(ids, return_inverse=True)
+		self.cipher1 = digraphs // 26
+		self.cipher2 = digraphs % 26
+		self.log_probs = log_probs
+		self.rng = rng
+		self.positions = np.array(_position_table(-1), dtype=np.intp)
+		self.letter_pos = np.zeros(26, dtype=np.intp)
+		self.pos_pairs = np.empty(len(digraphs), dtype=np.intp)
+		self.pos_second = np.empty(len(digraphs), dtype=np.intp)
+		self.digraph_pos = np.empty((len(digraphs), 2), dtype=np.intp)
+		self.digraph_plain = np.empty((len(digraphs), 2), dtype=np.intp)
+		self.plain = np.empty((len(ids), 2), dtype=np.intp)
+		self.quads = np.empty(len(codes) - 3, dtype=np.intp)
+		self.quad_probs = np.empty(len(codes) - 3, dtype=log_probs.dtype)
+		self.backup = np.empty(25, dtype=np.intp)
+		self.order = np.arange(25, dtype=np.intp)
+		# the grid positions after swapping two rows or two columns, or reversing the grid
+		square = self.order.reshape(5, 5)
+		pairs = [(i, j) for i in range(5) for j in range(i + 1, 5)]
+		self.row_swaps = [square[[*range(i), j, *range(i + 1, j), i, *range(j + 1, 5)]].ravel() for i, j in pairs]
+		self.column_swaps = [square[:, [*range(i), j, *range(i + 1, j), i, *range(j + 1, 5)]].ravel() for i, j in pairs]
+		self.reverse = self.order[::-1].copy()
+
+	def score(self, grid) -> float:
+		np = vector.np
+		np.put(self.letter_pos, grid, self.order)
+		self.letter_pos[9] = self.letter_pos[8]
+		pos_pairs = self.pos_pairs
+		np.take(self.letter_pos, self.cipher1, out=pos_pairs)
+		pos_pairs *= 25
+		pos_pairs += np.take(self.letter_pos, self.cipher2, out=self.pos_second)
+		np.take(self.positions, pos_pairs, axis=0, out=self.digraph_pos)
+		np.take(grid, self.digraph_pos, out=self.digraph_plain)
+		np.take(self.digraph_plain, self.digraph_index, axis=0, out=self.plain)
+		plain = self.plain.reshape(-1)
+		quads = self.quads
+		np.multiply(plain[:-3], 26, out=quads)
+		quads += plain[1:-2]
+		quads *= 26
+		quads += plain[2:-1]
+		quads *= 26
+		quads += plain[3:]
+		return float(np.take(self.log_probs, quads, out=self.quad_probs).sum())
+
+	def mutate(self, grid):
+		"""Changes grid to a random neighbour, keeping what it was in self.backup."""
+		np = vector.np
+		rng = self.rng
+		np.copyto(self.backup, grid)
+		move = rng.random()
+		if move < 0.9:
+			i = rng.randrange(25)
+			j = rng.randrange(24)
+			j += j >= i
+			grid[i] = self.backup.item(j)
+			grid[j] = self.backup.item(i)
+			return
+		if move < 0.94:
+			positions = self.row_swaps[rng.randrange(10)]
+		elif move < 0.98:
+			positions = self.column_swaps[rng.randrange(10)]
+		else:
+			positions = self.reverse
+		np.take(self.backup, positions, out=grid)
+
+	def anneal(self, start_temp: float, deadline: float):
+		"""Anneals from a random grid, cooling from start_temp at the start to
+		nothing at the deadline, however fast candidates are scored."""
+		np = vector.np
+		rng = self.rng
+		grid = np.array(rng.sample(_GRID_LETTERS, 25), dtype=np.intp)
+		score = self.score(grid)
+		best, best_score = grid.copy(), score
+		backup = self.backup
+		start = time.time()
+		span = deadline - start
+		temp = start_temp
+		for i in count():
+			if not i % 256:
+				remaining = deadline - time.time()
+				if remaining <= 0:
+					break
+				temp = start_temp * remaining / span
+			self.mutate(grid)
+			new_score = self.score(grid)
+			delta = new_score - score
+			if delta >= 0 or rng.random() < math.exp(delta / temp):
+				score = new_score
+				if score > best_score:
+					best_score = score
+					np.copyto(best, grid)
+			else:
+				np.copyto(grid, backup)
+		return best_score, best
+
+
+_GRID_LETTERS = [c for c in range(26) if c != 9]
+# the annealer's start temperature per letter of ciphertext, since a move's change
+# to the log10 quadgram score grows with the length (about 37 for 600 letters)
+START_TEMP_PER_LETTER = 0.06
+
+
+def _anneal_until(codes, ngrams, deadline: float, seed: int, restart_seconds: float):
+	rng = random.Random(seed)
+	annealer = _Annealer(codes, ngrams.table(4), rng)
+	start_temp = START_TEMP_PER_LETTER * len(codes)
+	start = time.time()
+	# each restart cools fully in its share of the time
+	restarts = max(round((deadline - start) / restart_seconds), 1)
+	share = (deadline - start) / restarts
+	results = []
+	for restart in range(1, restarts + 1):
+		score, grid = annealer.anneal(start_temp, start + restart * share)
+		results.append((score, vector.to_str(grid, OFFSET_UPPER)))
+	return results
+
+
+def solve(message: str, ngrams, seconds: float = 60, workers: int | None = None,
+		restart_seconds: float = 10, top: int = 5):
+	"""Searches for the grid of a letters-only ciphertext, running independent
+	annealers in a process pool until the time budget is spent, each restarting
+	about every restart_seconds.
+	Returns (fitness, grid) pairs, best first; fitness is the mean log10 quadgram probability."""
+	from concurrent.futures import ProcessPoolExecutor
+	codes = _ensure_ciphertext_array(message).ravel()
+	if len(codes) < 4:
+		raise ValueError('ciphertext is too short to solve')
+	workers = workers or os.cpu_count() or 1
+	deadline = time.time() + seconds
+	with ProcessPoolExecutor(workers) as pool:
+		futures = [
+			pool.submit(_anneal_until, codes, ngrams, deadline, random.randrange(1 << 32), restart_seconds)
+			for _ in range(workers)]
+		results = dict((grid, score) for f in futures for score, grid in f.result())
+	ranked = sorted(((score / (len(codes) - 3), grid) for grid, score in results.items()), reverse=True)
+	return ranked[:top]
 
 
 if __name__ == '__main__':
@@ -115,14 +387,42 @@ if __name__ == '__main__':
 		description=f"Applies the Playfair Cipher to a message. {cryptoshell.MODE_HELP}",
 		epilog='Invented by Sir Charles Wheatstone in 1854, popularized by Lord Playfair.')
 	cryptoshell.input_args(parser)
-	parser.add_argument('-k', '--key', type=str, required=True,
+	key_group = parser.add_mutually_exclusive_group(required=True)
+	key_group.add_argument('-k', '--key', type=str,
 		help='The cipher key, which may be the full grid or a keyword. Row separators (such as commas) may be included, as all invalid characters are ignored.')
+	key_group.add_argument('--solve', metavar='CORPUS', type=str,
+		help='Search for the grid from the ciphertext alone, scoring candidates with quadgrams from this file: an index built by fitness.py, or English text to count them from. Assumes IJ are combined.')
 	parser.add_argument('-s', '--separator', type=str, default='XQ',
 		help='The letter for separating double letters and padding an odd-length message. If two letters are given, the second is used to separate doubles of the first letter if they occur. (default: XQ)')
 	parser.add_argument('-c', '--combine', type=str, default='IJ',
 		help='The letter pair that must be combined when using a 5x5 grid. The first letter stands in for the second. (default: IJ)')
+	parser.add_argument('-t', '--time', type=float, default=60,
+		help='the number of seconds to spend solving (default: 60)')
+	parser.add_argument('-w', '--workers', type=int,
+		help='the number of processes to solve with. Defaults to one per CPU.')
+	parser.add_argument('-a', '--analyze', type=int, default=75,
+		help='The maximum length of each decryption shown when solving. Defaults to 75. Use 0 for no limit.')
 	cryptoshell.mode_args(parser)
+	cryptoshell.batch_args(parser)
+	cryptoshell.stream_args(parser)
+	cryptoshell.stats_args(parser)
+	cryptoshell.daemon_args(parser)
 	args = parser.parse_args()
+	stats = cryptoshell.Stats.from_args(args)
+
+	if args.solve:
+		if vector is None:
+			parser.error('--solve requires NumPy')
+		from fitness import NGrams
+
+		message = BASIC_TABLE.translate(cryptoshell.get_message(args))
+		ngrams = NGrams.from_file(args.solve)
+		preview = message[:args.analyze or None]
+		preview = preview[:len(preview) // 2 * 2]
+		print('\n'.join(
+			f"{grid}:{Playfair(list(batched(grid, 5))).decrypt(preview)}"
+			for _, grid in solve(message, ngrams, args.time, args.workers)), end='')
+		sys.exit()
 
 	separators = args.separator.upper()
 	separator = separators[0]
@@ -133,5 +433,13 @@ if __name__ == '__main__':
 	else:
 		alt_separator = 'Q' if separator != 'Q' else 'X'
 
-	cipher = Playfair.from_keyword(args.key, separator, alt_separator, args.combine)
-	cryptoshell.run_cipher(args, cipher.encrypt, cipher.decrypt)
+	from functools import partial
+
+	options = {'separator': separator, 'alt_separator': alt_separator, 'combine': args.combine}
+	if cryptoshell.forward(args, 'playfair', args.key, options):
+		sys.exit()
+	cipher_for = partial(cached, Playfair, **options)
+	with stats.phase('setup'):
+		cipher = cipher_for(args.key)
+	cryptoshell.run_cipher(args, cipher.encrypt_into, cipher.decrypt_into, cipher_for=cipher_for, stats=stats,
+		cipher=cipher)
@@ -1,3 +1,7 @@
+import re
+import subprocess
+import sys
+
 from adfgvx import Adfgvx
 from crypto import batched
 
@@ -5,4 +9,17 @@ grid = batched('NA1C3H8TB2OME5WRPD4F6G7I9J0KLQSUVXYZ', 6)
 a = Adfgvx(grid, 'PRIVACY')
 c = a.encrypt('attackat1200am')
 print(c, len(c))
-print(a.decrypt(c))
\ No newline at end of file
+print(a.decrypt(c))
+
+# a short run through python -m crypto must not import NumPy, and its imports
+# (as timed by -X importtime) must stay under this many milliseconds
+IMPORT_BUDGET_MS = 100
+
+run = subprocess.run([sys.executable, '-X', 'importtime', '-m', 'crypto', 'vigenere', '-k', 'LEMON', '--local'],
+	input='attackatdawn', capture_output=True, text=True, check=True)
+print(run.stdout)
+imports = re.findall(r'^import time:\s+\d+ \|\s+(\d+) \|( *)(\S+)$', run.stderr, re.M)
+assert not [name for *_, name in imports if name.split('.')[0] == 'numpy'], 'a short message imported NumPy'
+total = sum(int(us) for us, indent, _ in imports if len(indent) == 1) / 1000
+print(f"imports took {total:.1f} ms")
+assert total < IMPORT_BUDGET_MS, f"imports took {total:.1f} ms, over the budget of {IMPORT_BUDGET_MS} ms"
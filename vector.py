@@ -0,0 +1,73 @@
+from __future__ import annotations
+
+import importlib.util
+import sys
+from collections.abc import Buffer
+
+from crypto import OFFSET_UPPER
+
+
+def _lazy_import(name: str):
+	"""The module, imported on first use of one of its attributes. Raises ImportError now if it is not installed."""
+	if name in sys.modules:
+		return sys.modules[name]
+	spec = importlib.util.find_spec(name)
+	if spec is None:
+		raise ImportError(f"No module named {name!r}", name=name)
+	spec.loader = importlib.util.LazyLoader(spec.loader)
+	module = importlib.util.module_from_spec(spec)
+	sys.modules[name] = module
+	spec.loader.exec_module(module)
+	return module
+
+
+# NumPy takes longer to import than most short messages take to cipher, so it
+# is only imported once a message is long enough to use it (see accepts)
+np = _lazy_import('numpy')
+
+# below this, converting to and from arrays costs more than it saves
+MIN_LEN = 4096
+
+
+def accepts(message: str | Buffer):
+	if isinstance(message, str):
+		return len(message) >= MIN_LEN and message.isascii()
+	return memoryview(message).nbytes >= MIN_LEN
+
+
+def ascii_array(s: str | Buffer) -> np.ndarray:
+	if isinstance(s, str):
+		s = s.encode('ascii')
+	return np.frombuffer(s, dtype=np.uint8)
+
+
+def letter_codes(s: str | Buffer) -> np.ndarray:
+	# same as crypto.to_code; uint8 wraparound agrees with the mask
+	return (ascii_array(s) - OFFSET_UPPER) & 0x1F
+
+
+def tile(codes: np.ndarray, length: int) -> np.ndarray:
+	reps = -(-length // len(codes))
+	return np.tile(codes, reps)[:length]
+
+
+def to_str(codes: np.ndarray, offset: int = 0) -> str:
+	return (codes + offset).astype(np.uint8).tobytes().decode('ascii')
+
+
+def write(codes: np.ndarray, offset: int, out: Buffer):
+	"""Writes codes + offset into a writable buffer of the same length."""
+	np.add(codes, offset, out=np.frombuffer(out, dtype=np.uint8), casting='unsafe')
+
+
+def pair_table(pairs: bytes) -> np.ndarray:
+	"""Views a flat digraph table of two-byte pairs, with 0 for missing entries, as a read-only (len, 2) array of ASCII codes."""
+	return np.frombuffer(pairs, dtype=np.uint8).reshape(-1, 2)
+
+
+def gather_pairs(pairs: np.ndarray, table: np.ndarray, out: Buffer):
+	"""Looks up each (c1, c2) row of pairs in a pair_table, writing the results into out."""
+	out = np.frombuffer(out, dtype=np.uint8).reshape(-1, 2)
+	np.take(table, pairs[:, 0].astype(np.intp) * 26 + pairs[:, 1], axis=0, out=out)
+	if not out.all():
+		raise ValueError('message has letters missing from the table')
@@ -1,24 +1,256 @@
-from itertools import cycle
+import mmap
+import os
+from collections.abc import Buffer
 
-from crypto import OFFSET_LOWER, OFFSET_UPPER, to_code, collect_to_str
+import modular
+from crypto import (BASIC_TABLE, ENGLISH_FREQ, LETTERS, OFFSET_UPPER, Alphabet, BufferCipher, cached, get_alphabet,
+	text_call)
 
+try:
+	import vector
+except ImportError:
+	vector = None
 
-@collect_to_str
-def vigenere(message: str, key: str, sign: int, offset: int):
-	for a, k in zip(message, cycle(sign * to_code(k) for k in key)):
-		yield chr((to_code(a) + k) % 26 + offset)
 
+def vigenere_into(data: Buffer, key: str | Buffer, sign: int, out: Buffer | None = None, position: int = 0,
+		alphabet: Alphabet = LETTERS):
+	"""The key may be a str or a buffer of ASCII codes, such as a slice of a Pad.
+	position is where data starts in the message, for a message in chunks."""
+	return modular.vigenere_into(data, alphabet, alphabet.codes(key), sign, out, position)
 
-def encrypt(message: str, key: str):
-	return vigenere(message, key, +1, OFFSET_UPPER)
 
+def vigenere(message: str, key: str | Buffer, sign: int, alphabet: Alphabet = LETTERS):
+	return text_call(vigenere_into, message, key, sign, alphabet=alphabet)
 
-def decrypt(message: str, key: str):
-	return vigenere(message, key, -1, OFFSET_LOWER)
+
+def encrypt_into(data: Buffer, key: str | Buffer, out: Buffer | None = None, position: int = 0,
+		alphabet: Alphabet = LETTERS):
+	return vigenere_into(data, key, +1, out, position, alphabet)
+
+
+def decrypt_into(data: Buffer, key: str | Buffer, out: Buffer | None = None, position: int = 0,
+		alphabet: Alphabet = LETTERS):
+	return vigenere_into(data, key, -1, out, position, alphabet)
+
+
+def encrypt(message: str, key: str, alphabet: Alphabet = LETTERS):
+	return vigenere(message, key, +1, alphabet)
+
+
+def decrypt(message: str, key: str, alphabet: Alphabet = LETTERS):
+	return vigenere(message, key, -1, alphabet)
+
+
+class Vigenere(BufferCipher):
+	__slots__ = ('key', 'alphabet')
+	seekable = True
+
+	def __init__(self, key: str | Buffer, alphabet: Alphabet | str = LETTERS):
+		self.alphabet = get_alphabet(alphabet)
+		self.key = self.alphabet.codes(key)
+
+	@classmethod
+	def cache_key(cls, key: str | Buffer, alphabet: Alphabet | str = LETTERS):
+		alphabet = get_alphabet(alphabet)
+		return alphabet.codes(key), alphabet.chars
+
+	def encrypt_into(self, data: Buffer, out: Buffer | None = None, position: int = 0):
+		return modular.vigenere_into(data, self.alphabet, self.key, +1, out, position)
+
+	def decrypt_into(self, data: Buffer, out: Buffer | None = None, position: int = 0):
+		return modular.vigenere_into(data, self.alphabet, self.key, -1, out, position)
+
+
+LEDGER_SUFFIX = '.ledger'
+
+
+class Pad:
+	"""A one-time pad file, mapped into memory rather than read, with a sidecar
+	ledger of the byte ranges already used so that no run uses them again."""
+
+	def __init__(self, path: str):
+		self.path = os.fspath(path)
+		self.ledger_path = self.path + LEDGER_SUFFIX
+		with open(self.path, 'rb') as f:
+			if not os.fstat(f.fileno()).st_size:
+				raise ValueError(f"pad is empty: {self.path}")
+			self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.map.close()
+
+	def used(self) -> list[tuple[int, int]]:
+		"""The (start, end) byte ranges already used, in order."""
+		try:
+			with open(self.ledger_path, encoding='ascii') as f:
+				return [tuple(map(int, line.split())) for line in f if line.strip()]
+		except FileNotFoundError:
+			return []
+
+	def next_offset(self):
+		return max((end for _, end in self.used()), default=0)
+
+	def reserve(self, length: int, offset: int | None = None) -> int:
+		"""Records length bytes from offset (by default, the end of the last range
+		used) in the ledger and returns the offset. The ledger is updated before
+		the key is used, so a failed run still burns its range."""
+		lock_path = self.ledger_path + '.lock'
+		try:
+			lock = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+		except FileExistsError:
+			raise ValueError(f"pad is in use by another run (delete {lock_path} if none is running)") from None
+		try:
+			used = self.used()
+			start = max((end for _, end in used), default=0) if offset is None else offset
+			end = start + length
+			if start < 0 or end > len(self.map):
+				raise ValueError(f"pad is exhausted: {length} bytes needed at offset {start}, but it has {len(self.map)}")
+			for s, e in used:
+				if s < end and start < e:
+					raise ValueError(f"pad bytes {max(s, start)} to {min(e, end)} were already used")
+			if length:
+				self._write_ledger(sorted(used + [(start, end)]))
+		finally:
+			os.close(lock)
+			os.remove(lock_path)
+		return start
+
+	def key(self, offset: int, length: int) -> memoryview:
+		"""A view of the pad, without copying. Release it before closing the pad."""
+		return memoryview(self.map)[offset:offset + length]
+
+	def _write_ledger(self, ranges: list[tuple[int, int]]):
+		merged = []
+		for start, end in ranges:
+			if merged and start <= merged[-1][1]:
+				merged[-1][1] = max(merged[-1][1], end)
+			else:
+				merged.append([start, end])
+		temp_path = self.ledger_path + '.tmp'
+		with open(temp_path, 'w', encoding='ascii') as f:
+			f.writelines(f"{start} {end}\n" for start, end in merged)
+			f.flush()
+			os.fsync(f.fileno())
+		os.replace(temp_path, self.ledger_path)
+
+
+# Solver: the statistics below need NumPy and expect letters only.
+
+KASISKI_SAMPLE = 1 << 20
+KASISKI_WEIGHT = 0.05
+# shorter columns give meaningless statistics
+MIN_COLUMN_LEN = 20
+# letters of the message decrypted with each candidate key to rank them by n-gram fitness
+RANK_SAMPLE = 1 << 16
+
+
+def column_histograms(codes, key_len: int):
+	"""Letter counts of each of the key_len columns, as a (key_len, 26) array."""
+	np = vector.np
+	rows = len(codes) // key_len
+	grid = codes[:rows * key_len].reshape(rows, key_len)
+	lanes = grid + np.arange(0, 26 * key_len, 26, dtype=np.int16)
+	counts = np.bincount(lanes.ravel(), minlength=26 * key_len)
+	return counts.reshape(key_len, 26)
+
+
+def coincidence(codes, max_len: int = 200):
+	"""Mean index of coincidence of the columns for each key length, scaled so
+	random text scores 1.0 and English about 1.73. Index 0 is unused."""
+	np = vector.np
+	scores = np.zeros(max_len + 1)
+	for key_len in range(1, min(max_len, len(codes) // MIN_COLUMN_LEN) + 1):
+		counts = column_histograms(codes, key_len).astype(np.float64)
+		totals = counts.sum(axis=1)
+		ic = (counts * (counts - 1)).sum(axis=1) / (totals * (totals - 1))
+		scores[key_len] = 26 * ic.mean()
+	return scores
+
+
+def kasiski(codes, max_len: int = 200):
+	"""How much more often than chance the spacing between repeated trigrams
+	is a multiple of each key length. Index 0 is unused."""
+	np = vector.np
+	codes = codes[:KASISKI_SAMPLE].astype(np.int32)
+	scores = np.zeros(max_len + 1)
+	if len(codes) < 3:
+		return scores
+	trigrams = codes[:-2] * 676 + codes[1:-1] * 26 + codes[2:]
+	order = np.argsort(trigrams, kind='stable')
+	repeats = trigrams[order[1:]] == trigrams[order[:-1]]
+	spacing = np.diff(order)[repeats]
+	if not len(spacing):
+		return scores
+	for key_len in range(1, max_len + 1):
+		scores[key_len] = np.count_nonzero(spacing % key_len == 0) * key_len / len(spacing)
+	return scores
+
+
+def key_lengths(codes, max_len: int = 200):
+	"""Candidate key lengths, most likely first. A length is replaced by its
+	smallest divisor that scores nearly as well, since every multiple of the
+	true length looks just as good."""
+	ic = coincidence(codes, max_len)
+	repeats = kasiski(codes, max_len)
+	score = ic + KASISKI_WEIGHT * (repeats - 1)
+	ranked = []
+	for key_len in sorted(range(1, len(ic)), key=lambda n: -score[n]):
+		if not ic[key_len]:
+			continue
+		key_len = min(d for d in range(1, key_len + 1)
+			if key_len % d == 0 and ic[d] >= 0.9 * ic[key_len])
+		if key_len not in ranked:
+			ranked.append(key_len)
+	return ranked
+
+
+def shift_log_likelihood(counts):
+	"""Log-likelihood of each column under each of the 26 shifts, as a
+	(columns, 26) array where [j, k] decrypts column j with key letter k."""
+	np = vector.np
+	log_freq = np.log(np.array(ENGLISH_FREQ))
+	rotations = (np.arange(26)[:, np.newaxis] + np.arange(26)) % 26
+	# plaintext letter x under key k came from ciphertext letter x + k
+	return counts[:, rotations] @ log_freq
+
+
+def solve(message: str, max_len: int = 200, lengths: int = 3, top: int = 5, ngrams=None):
+	"""Recovers likely keys from a letters-only ciphertext.
+	Returns (fitness, key) pairs, best first; fitness is the mean log-likelihood per
+	letter, or with ngrams (see fitness.NGrams), the mean log10 quadgram probability
+	of each key's decryption."""
+	np = vector.np
+	codes = vector.letter_codes(message)
+	candidates = {}
+	for key_len in key_lengths(codes, max_len)[:lengths]:
+		scores = shift_log_likelihood(column_histograms(codes, key_len))
+		order = np.argsort(-scores, axis=1)
+		best = order[:, 0]
+		keys = [best]
+		# also try the runner-up letter in the columns the solver was least sure of
+		margins = scores[np.arange(key_len), best] - scores[np.arange(key_len), order[:, 1]]
+		for j in np.argsort(margins)[:top]:
+			alt = best.copy()
+			alt[j] = order[j, 1]
+			keys.append(alt)
+		for k in keys:
+			fitness = float(scores[np.arange(key_len), k].sum()) / len(codes)
+			candidates[vector.to_str(k, OFFSET_UPPER)] = fitness
+	if ngrams is not None and len(codes) >= 4:
+		keys = list(candidates)
+		sample = codes[:RANK_SAMPLE].astype(np.int16)
+		plain = (sample - np.array([vector.tile(vector.letter_codes(k), len(sample)) for k in keys])) % 26
+		candidates = dict(zip(keys, (ngrams.score_batch(plain) / (len(sample) - 3)).tolist()))
+	ranked = sorted(((f, k) for k, f in candidates.items()), reverse=True)
+	return ranked[:top]
 
 
 if __name__ == '__main__':
 	import argparse
+	import sys
 	from functools import partial
 
 	import cryptoshell
@@ -32,16 +264,60 @@ if __name__ == '__main__':
 	key_group.add_argument('-k', '--key', type=str, 
 		help='the cipher key')
 	key_group.add_argument('-p', '--pad', metavar='FILE', type=str,
-		help='a file containing the cipher key (ideal for one-time pads)')
+		help=f"A file containing the cipher key (ideal for one-time pads). Each run uses the pad from where the last run stopped, recording the bytes used in FILE{LEDGER_SUFFIX}, and fails rather than reuse any.")
+	key_group.add_argument('-s', '--solve', action='store_true',
+		help='recover likely keys from the ciphertext alone and show the start of each decryption')
+	parser.add_argument('-o', '--offset', type=int,
+		help='with --pad, the byte offset to start the key at, such as one given by the sender. The default is the next unused byte.')
+	parser.add_argument('-m', '--max-length', type=int, default=200,
+		help='the longest key length to consider when solving (default: 200)')
+	parser.add_argument('-a', '--analyze', type=int, default=75,
+		help='The maximum length of each decryption shown when solving. Defaults to 75. Use 0 for no limit.')
+	parser.add_argument('--corpus', metavar='FILE', type=str,
+		help='when solving, rank the keys by the n-gram fitness of their decryptions, from an index built by fitness.py or a file of English text to count them from')
+	cryptoshell.alphabet_args(parser)
 	cryptoshell.mode_args(parser)
+	cryptoshell.batch_args(parser)
+	cryptoshell.stream_args(parser)
+	cryptoshell.stats_args(parser)
+	cryptoshell.daemon_args(parser)
 	args = parser.parse_args()
+	stats = cryptoshell.Stats.from_args(args)
+	options = {'alphabet': args.alphabet} if args.alphabet else {}
+	alphabet = get_alphabet(args.alphabet or LETTERS.chars)
 
-	if args.key is not None:
-		key = args.key
-	else:
-		with open(args.pad, encoding='UTF-8') as f:
-			key = f.read()
-
-	cryptoshell.run_cipher(args, 
-		partial(encrypt, key=key),
-		partial(decrypt, key=key))
+	if args.solve:
+		if vector is None:
+			parser.error('--solve requires NumPy')
+		if alphabet is not LETTERS:
+			parser.error('--solve works only in the 26 letters')
+		message = BASIC_TABLE.translate(cryptoshell.get_message(args))
+		ngrams = None
+		if args.corpus:
+			from fitness import NGrams
+			ngrams = NGrams.from_file(args.corpus)
+		preview = message[:args.analyze or None]
+		print('\n'.join(
+			f"{key}:{decrypt(preview, key)}" for _, key in solve(message, args.max_length, ngrams=ngrams)), end='')
+	elif args.pad is not None:
+		if args.batch or args.stream:
+			parser.error('--pad cannot be used with --batch or --stream')
+		with Pad(args.pad) as pad:
+			# the message is needed first to know how much of the pad to reserve
+			with stats.phase('read'):
+				message = cryptoshell.read_message(args)
+			stats.count('input', len(message))
+			with stats.phase('filter'):
+				message = alphabet.text_filter.translate_bytes(message)
+			with stats.phase('setup'):
+				offset = pad.reserve(len(message), args.offset)
+			print(f"pad offset {offset}", file=sys.stderr)
+			with pad.key(offset, len(message)) as key:
+				cryptoshell.run_cipher(args, 
+					partial(encrypt_into, key=key, alphabet=alphabet),
+					partial(decrypt_into, key=key, alphabet=alphabet),
+					alphabet.text_filter, message=message, stats=stats)
+	elif not cryptoshell.forward(args, 'vigenere', args.key, options):
+		cipher = Vigenere(args.key, alphabet)
+		cryptoshell.run_cipher(args, cipher.encrypt_into, cipher.decrypt_into, alphabet.text_filter,
+			cipher_for=partial(cached, Vigenere, **options), stats=stats, cipher=cipher)